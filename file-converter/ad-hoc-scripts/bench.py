@@ -0,0 +1,304 @@
+"""
+Load test for the converter, runs the app in-process through an ASGI client.
+
+    python bench.py                          # stub ddjvu, 300 requests per workload
+    python bench.py --real --pages 40 -n 80  # real djvulibre tools + synthetic books
+    python bench.py -c 64 -n 2000 --stub-ms 50 --json
+
+Every workload needs pages of its own (cold + the cold part of mixed = 2 * n),
+--pages defaults to just enough of them. Fewer pages than that lowers -n.
+
+Workloads:
+    cold   every request is a page nobody asked for yet
+    warm   the same pages again, all cache hits
+    mixed  --hot-ratio of requests go to warm pages, the rest to cold ones
+Warm pages are only the cold ones that came back 200, the report says how
+many were left out.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+
+# stand-ins for ddjvu/djvused so the service can be benchmarked without
+# djvulibre. they only sleep and write a tiny image, so the numbers measure
+# our scheduling/caching overhead, not rendering.
+_STUB_DDJVU = r"""#!{python}
+import os, sys, time
+time.sleep(float(os.environ.get("STUB_MS", "20")) / 1000)
+args = sys.argv[1:]
+out = args[-1]
+pnm = "-format=pnm" in args
+page = next(a.split("=", 1)[1] for a in args if a.startswith("-page="))
+first, _, last = page.partition("-")
+pages = range(int(first), int(last or first) + 1)
+body = b"P6\n1 1\n255\n\x00\x00\x00" if pnm else bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108000000003a7e9b55"
+    "0000000a49444154789c636000000002000148afa4710000000049454e44ae426082"
+)
+for p in pages:
+    with open(out % p if "-eachpage" in args else out, "wb") as f:
+        f.write(body)
+"""
+
+_STUB_DJVUSED = r"""#!{python}
+import os, sys
+script = sys.argv[sys.argv.index("-e") + 1]
+if script.strip() == "n":
+    print(os.environ.get("STUB_PAGES", "100"))
+else:
+    for _ in range(script.count("size")):
+        print("width=2550 height=3300")
+"""
+
+
+def make_stub_bin(root: Path) -> Path:
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    for name, src in (("ddjvu", _STUB_DDJVU), ("djvused", _STUB_DJVUSED)):
+        p = bin_dir / name
+        p.write_text(src.replace("{python}", sys.executable))
+        p.chmod(0o755)
+    return bin_dir
+
+
+def make_stub_books(data_dir: Path, books: int):
+    for i in range(books):
+        # the stubs never read it, only the size matters (book_size label)
+        (data_dir / f"book{i}.djvu").write_bytes(os.urandom(64 * 1024))
+
+
+def make_real_books(data_dir: Path, books: int, pages: int, work: Path):
+    """Synthetic scans: noisy gradient pages -> c44 -> bundled with djvm."""
+    for b in range(books):
+        page_files = []
+        for p in range(pages):
+            ppm = work / f"b{b}p{p}.ppm"
+            w, h = 850, 1100
+            rnd = random.Random(b * 1000 + p)
+            row = bytes(
+                v
+                for x in range(w)
+                for v in ((x + p) % 256, rnd.randrange(256), (x * 3) % 256)
+            )
+            with open(ppm, "wb") as f:
+                f.write(f"P6\n{w} {h}\n255\n".encode())
+                for _ in range(h):
+                    f.write(row)
+            djvu = work / f"b{b}p{p}.djvu"
+            subprocess.run(
+                ["c44", str(ppm), str(djvu)], check=True, capture_output=True
+            )
+            page_files.append(str(djvu))
+        subprocess.run(
+            ["djvm", "-c", str(data_dir / f"book{b}.djvu"), *page_files],
+            check=True,
+            capture_output=True,
+        )
+
+
+def percentile(sorted_vals: list, q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, round(q / 100 * len(sorted_vals)) - 1))
+    return sorted_vals[idx]
+
+
+async def drive(client, urls: list, concurrency: int, ok: list = None) -> dict:
+    # urls that came back 200 are appended to `ok`
+    latencies = []
+    statuses = {}
+    it = iter(urls)
+
+    async def worker():
+        for url in it:
+            t = time.perf_counter()
+            r = await client.get(url)
+            latencies.append(time.perf_counter() - t)
+            statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+            if ok is not None and r.status_code == 200:
+                ok.append(url)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(urls),
+        "seconds": round(elapsed, 3),
+        "rps": round(len(urls) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "status": statuses,
+    }
+
+
+async def run(args, data_dir: Path) -> dict:
+    import httpx
+
+    sys.path.insert(0, str(SRC_DIR))
+    import main
+    from cache import page_cache
+
+    if not args.verbose:
+        # one json line per request would drown the report
+        logging.getLogger("file-converter").setLevel(logging.WARNING)
+
+    books = [p.stem for p in sorted(data_dir.glob("*.djvu"))]
+    all_pages = [(b, p) for p in range(1, args.pages + 1) for b in books]
+    rnd = random.Random(args.seed)
+    rnd.shuffle(all_pages)
+
+    n = args.requests
+    cold_pages, fresh_pages = all_pages[:n], all_pages[n : 2 * n]
+
+    def url(book_page):
+        return f"/page/{book_page[0]}/{book_page[1]}"
+
+    results = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        # warm up the book index so the first workload isn't charged for it
+        await client.get("/books")
+
+        hot = []
+        results["cold"] = await drive(
+            client, [url(p) for p in cold_pages], args.concurrency, hot
+        )
+        # a page that failed cold (503, 500) isn't cached, hitting it again
+        # would be another cold render counted as warm
+        hot.sort()  # finish order varies, keep --seed reproducible
+        excluded = n - len(hot)
+
+        warm = [rnd.choice(hot) for _ in range(n)] if hot else []
+        results["warm"] = await drive(client, warm, args.concurrency)
+
+        fresh = iter(fresh_pages)
+        mixed = [
+            rnd.choice(hot)
+            if hot and rnd.random() < args.hot_ratio
+            else url(next(fresh))
+            for _ in range(n)
+        ]
+        results["mixed"] = await drive(client, mixed, args.concurrency)
+        results["warm"]["excluded"] = results["mixed"]["excluded"] = excluded
+
+    results["cache"] = page_cache.stats()
+    return results
+
+
+def print_table(results: dict):
+    cols = ("requests", "seconds", "rps", "p50_ms", "p95_ms", "p99_ms")
+    print(f"{'workload':<8}" + "".join(f"{c:>10}" for c in cols) + "  status")
+    for name in ("cold", "warm", "mixed"):
+        r = results[name]
+        print(f"{name:<8}" + "".join(f"{r[c]:>10}" for c in cols) + f"  {r['status']}")
+    if results["warm"]["excluded"]:
+        print(
+            f"\nwarm + mixed left out {results['warm']['excluded']} pages that failed cold"
+        )
+    c = results["cache"]
+    print(
+        f"\ncache: {c['hits']} hits, {c['misses']} misses, {c['evictions']} evictions"
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    ap.add_argument(
+        "-n", "--requests", type=int, default=300, help="requests per workload"
+    )
+    ap.add_argument("-c", "--concurrency", type=int, default=16)
+    ap.add_argument("--books", type=int, default=4)
+    ap.add_argument("--pages", type=int, help="pages per book, default: enough for -n")
+    ap.add_argument(
+        "--hot-ratio", type=float, default=0.8, help="share of warm pages in 'mixed'"
+    )
+    ap.add_argument(
+        "--real", action="store_true", help="use installed djvulibre (c44, djvm, ddjvu)"
+    )
+    ap.add_argument(
+        "--stub-ms", type=float, default=20, help="fake ddjvu time per call"
+    )
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument(
+        "--keep", action="store_true", help="keep the temp corpus + cache dir"
+    )
+    ap.add_argument("--json", action="store_true", help="print results as json")
+    ap.add_argument(
+        "-v", "--verbose", action="store_true", help="keep the per-request timing log"
+    )
+    args, extra_env = ap.parse_known_args()
+
+    # cold and mixed each need n pages nobody asked for yet
+    needed = 2 * args.requests
+    if args.pages is None:
+        args.pages = -(-needed // args.books)
+    elif args.books * args.pages < needed:
+        args.requests = args.books * args.pages // 2
+        print(
+            f"only {args.books * args.pages} pages, running {args.requests} requests per workload",
+            file=sys.stderr,
+        )
+    if args.requests < 1:
+        sys.exit("need at least 2 pages")
+
+    root = Path(tempfile.mkdtemp(prefix="converter-bench-"))
+    data_dir, cache_dir = root / "data", root / "cache"
+    data_dir.mkdir()
+    cache_dir.mkdir()
+
+    try:
+        if args.real:
+            missing = [
+                t for t in ("c44", "djvm", "ddjvu", "djvused") if not shutil.which(t)
+            ]
+            if missing:
+                sys.exit(f"--real needs djvulibre, missing: {', '.join(missing)}")
+            make_real_books(data_dir, args.books, args.pages, root)
+        else:
+            os.environ["PATH"] = (
+                f"{make_stub_bin(root)}{os.pathsep}{os.environ['PATH']}"
+            )
+            os.environ["STUB_MS"] = str(args.stub_ms)
+            os.environ["STUB_PAGES"] = str(args.pages)
+            make_stub_books(data_dir, args.books)
+
+        # config.py reads env at import, so this has to happen before run() imports main.
+        # anything else (RENDER_CONCURRENCY=4, CACHE_POLICY=lfu, ...) can be passed as KEY=VALUE
+        os.environ["DJVU_DIR"] = str(data_dir)
+        os.environ["CACHE_DIR"] = str(cache_dir)
+        for kv in extra_env:
+            key, _, value = kv.partition("=")
+            os.environ[key] = value
+
+        results = asyncio.run(run(args, data_dir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
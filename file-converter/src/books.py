@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import os
+import re
+
+from config import BOOK_PROBE_CONCURRENCY, DJVU_DIR
+from metrics import log
+from render import RenderError, RenderQueueFull, SingleFlight, scheduler
+from variants import Variant
+
+_SIZE = re.compile(r"width=(\d+)\s+height=(\d+)")
+
+# a listing probe that finds the render queue full backs off and tries again
+_QUEUE_FULL_RETRIES = 5
+_QUEUE_FULL_BACKOFF_SEC = 0.25
+
+
+def book_path(book: str) -> str:
+    return f"{DJVU_DIR}/{book}.djvu"
+
+
+def source_stamp(st: os.stat_result) -> float:
+    """
+    When the book file last changed. ctime too, because a replaced file can
+    come with an older mtime (cp -p, rsync -t) but its ctime is always fresh.
+    Rendered pages older than this are stale.
+    """
+    return max(st.st_mtime, st.st_ctime)
+
+
+def page_version(st: os.stat_result, page: int, variant: Variant) -> str:
+    """Strong validator for one rendered page, changes whenever the book file does."""
+    raw = f"{st.st_mtime_ns}:{st.st_ctime_ns}:{st.st_size}:{page}:{variant.key}"
+    return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+
+class BookMeta:
+    __slots__ = ("name", "stamp", "pages", "sizes")
+
+    def __init__(self, name: str, stamp: float, pages: int, sizes: list):
+        self.name = name
+        self.stamp = stamp
+        self.pages = pages
+        self.sizes = sizes  # [(width, height)], index 0 is page 1
+
+    def as_dict(self, sizes: bool = True) -> dict:
+        d = {"name": self.name, "pages": self.pages}
+        if sizes:
+            d["sizes"] = [
+                {"page": i, "width": w, "height": h}
+                for i, (w, h) in enumerate(self.sizes, start=1)
+            ]
+        return d
+
+
+class BookIndex:
+    """
+    Page count and page sizes per book, probed with djvused the first time a
+    book is asked for and again whenever its file changes. Probes run on the
+    render scheduler so they share its cpu budget and backpressure.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._books = {}
+        self._probes = SingleFlight()
+        self._listing = asyncio.Semaphore(BOOK_PROBE_CONCURRENCY)
+        self._invalidate = []
+
+    def on_invalidate(self, fn):
+        """Call `fn(book)` whenever a known book changes or is removed."""
+        self._invalidate.append(fn)
+
+    def _invalidated(self, book: str):
+        for fn in self._invalidate:
+            fn(book)
+
+    async def get(self, book: str, st: os.stat_result = None) -> BookMeta:
+        """Raises FileNotFoundError for unknown books, RenderError if djvused fails."""
+        if st is None:
+            st = os.stat(book_path(book))
+        stamp = source_stamp(st)
+
+        meta = self._books.get(book)
+        if meta is not None and meta.stamp == stamp:
+            return meta
+        return await self._probes.do((book, stamp), lambda: self._probe(book, stamp))
+
+    async def _get_listed(self, book: str, st: os.stat_result) -> BookMeta:
+        # bounded, a listing of many new books must not take the whole render
+        # queue away from /page
+        async with self._listing:
+            for attempt in range(_QUEUE_FULL_RETRIES):
+                try:
+                    return await self.get(book, st)
+                except RenderQueueFull:
+                    await asyncio.sleep(_QUEUE_FULL_BACKOFF_SEC * 2**attempt)
+            return await self.get(book, st)
+
+    async def refresh(self) -> tuple:
+        """
+        Sync with what is in the book dir: forget removed books, probe new or
+        changed ones. Returns ([BookMeta], {book: error}) for the books that
+        could be probed and the ones that couldn't.
+        """
+        found = {}
+        with os.scandir(self.root) as it:
+            for f in it:
+                if f.name.endswith(".djvu") and f.is_file():
+                    found[f.name[: -len(".djvu")]] = f.stat()
+
+        for gone in set(self._books) - set(found):
+            del self._books[gone]
+            self._invalidated(gone)
+
+        names = sorted(found)
+        results = await asyncio.gather(
+            *(self._get_listed(name, found[name]) for name in names),
+            return_exceptions=True,
+        )
+        books, errors = [], {}
+        for name, result in zip(names, results):
+            if isinstance(result, BookMeta):
+                books.append(result)
+            elif isinstance(result, (RenderError, OSError)):
+                log.warning(f"probing {name} failed: {result}")
+                errors[name] = str(result)
+            else:
+                raise result
+        return books, errors
+
+    async def _probe(self, book: str, stamp: float) -> BookMeta:
+        djvu = book_path(book)
+        old = self._books.get(book)
+        if old is not None and old.stamp != stamp:
+            self._invalidated(book)
+
+        size = os.path.getsize(djvu)
+        out = await scheduler.submit(["djvused", "-e", "n", djvu], book_size=size)
+        try:
+            pages = int(out.split()[0])
+        except (IndexError, ValueError):
+            raise RenderError(f"djvused gave no page count for {book}")
+
+        script = "; ".join(f"select {i}; size" for i in range(1, pages + 1))
+        out = await scheduler.submit(["djvused", "-e", script, djvu], book_size=size)
+        sizes = [(int(w), int(h)) for w, h in _SIZE.findall(out.decode())]
+        if len(sizes) != pages:
+            raise RenderError(
+                f"djvused gave {len(sizes)} sizes for {pages} pages of {book}"
+            )
+
+        meta = BookMeta(book, stamp, pages, sizes)
+        self._books[book] = meta
+        return meta
+
+
+book_index = BookIndex(DJVU_DIR)
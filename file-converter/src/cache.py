@@ -0,0 +1,199 @@
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+from variants import DEFAULT, Variant
+from config import (
+    CACHE_DIR,
+    CACHE_MAX_BYTES,
+    CACHE_POLICY,
+    CACHE_LOW_WATERMARK,
+    CACHE_EVICT_GRACE_SEC,
+)
+
+
+def page_path(book: str, page: int, variant: Variant = DEFAULT) -> str:
+    # the default variant keeps the plain {book}_{page}.png name
+    return f"{CACHE_DIR}/{book}_{page}{variant.key}"
+
+
+class _Entry:
+    __slots__ = ("size", "mtime", "hits", "last_access")
+
+    def __init__(self, size: int, mtime: float, last_access: float):
+        self.size = size
+        self.mtime = mtime
+        self.hits = 0
+        self.last_access = last_access
+
+
+class PageCache:
+    """
+    Byte-bounded index over the rendered files in `root`.
+
+    Every cached file has an entry with its size and access stats. When the
+    total goes over `max_bytes`, files are evicted (lru or lfu) until it is
+    back under `low_watermark * max_bytes`. Files touched within `grace` seconds
+    are skipped, they are most likely still being sent.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes: int,
+        policy: str = "lru",
+        low_watermark: float = 0.9,
+        grace: float = 10.0,
+    ):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"unknown cache policy: {policy}")
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.low_watermark = low_watermark
+        self.grace = grace
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # insertion order doubles as lru order, oldest first
+        self._entries = OrderedDict()
+
+    def reconcile(self):
+        """
+        Rebuild the index from what is actually on disk. Leftover temp files
+        from interrupted renders are removed.
+        """
+        self._entries.clear()
+        self.total_bytes = 0
+
+        found = []
+        with os.scandir(self.root) as it:
+            for f in it:
+                if f.name.endswith(".tmp"):
+                    if f.is_dir():
+                        shutil.rmtree(f.path, ignore_errors=True)
+                    else:
+                        os.remove(f.path)
+                    continue
+                if not f.is_file():
+                    continue
+                st = f.stat()
+                # atime is bumped on every hit (see lookup), so it survives restarts
+                found.append((max(st.st_atime, st.st_mtime), f.path, st))
+
+        for last_access, path, st in sorted(found):
+            self._entries[path] = _Entry(st.st_size, st.st_mtime, last_access)
+            self.total_bytes += st.st_size
+
+        self._evict()
+
+    def has(self, path: str, not_before: float = 0.0) -> bool:
+        """Cached and not older than `not_before`. No stats, no touch (for background work)."""
+        entry = self._entries.get(path)
+        return entry is not None and entry.mtime >= not_before
+
+    def lookup(self, path: str, not_before: float = 0.0) -> bool:
+        """
+        Counted lookup for serving. Entries rendered before `not_before` (the
+        source book changed since) are removed and count as a miss.
+        """
+        entry = self._entries.get(path)
+        if entry is not None and entry.mtime < not_before:
+            self.remove(path)
+            self.invalidations += 1
+            entry = None
+        if entry is None or not os.path.exists(path):
+            if entry is not None:
+                self._drop(path)
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        self._touch(path, entry)
+        return True
+
+    def add(self, path: str):
+        """Register a freshly written file and evict if that put us over budget."""
+        st = os.stat(path)
+        old = self._entries.pop(path, None)
+        if old is not None:
+            self.total_bytes -= old.size
+        entry = _Entry(st.st_size, st.st_mtime, time.time())
+        self._entries[path] = entry
+        self.total_bytes += entry.size
+        # never the page we just wrote, the caller is about to serve it
+        self._evict(keep=path)
+
+    def remove(self, path: str):
+        if path in self._entries:
+            self._drop(path)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "policy": self.policy,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _touch(self, path: str, entry: _Entry):
+        entry.hits += 1
+        entry.last_access = time.time()
+        self._entries.move_to_end(path)
+        try:
+            os.utime(path, (entry.last_access, entry.mtime))
+        except OSError:
+            pass
+
+    def _drop(self, path: str):
+        entry = self._entries.pop(path)
+        self.total_bytes -= entry.size
+
+    def _candidates(self):
+        if self.policy == "lru":
+            return iter(list(self._entries))
+        # least hits first, oldest access breaks ties
+        return iter(
+            sorted(
+                self._entries,
+                key=lambda p: (self._entries[p].hits, self._entries[p].last_access),
+            )
+        )
+
+    def _evict(self, keep: str = None):
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        target = self.max_bytes * self.low_watermark
+        cutoff = time.time() - self.grace
+        for path in self._candidates():
+            if self.total_bytes <= target:
+                break
+            if path == keep or self._entries[path].last_access > cutoff:
+                continue
+            self._drop(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.evictions += 1
+
+
+page_cache = PageCache(
+    CACHE_DIR,
+    CACHE_MAX_BYTES,
+    CACHE_POLICY,
+    CACHE_LOW_WATERMARK,
+    CACHE_EVICT_GRACE_SEC,
+)
@@ -0,0 +1,48 @@
+# ---------------------------
+# Settings, all overridable via env
+# ---------------------------
+
+import os
+
+DJVU_DIR = os.environ.get("DJVU_DIR", "/data")
+CACHE_DIR = os.environ.get("CACHE_DIR", "/cache")
+
+# ddjvu is single threaded and cpu bound, so one per core is the sweet spot
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", os.cpu_count() or 1))
+# renders allowed to wait for a free worker before we start answering 503
+RENDER_QUEUE_SIZE = int(os.environ.get("RENDER_QUEUE_SIZE", RENDER_CONCURRENCY * 8))
+RENDER_TIMEOUT_SEC = float(os.environ.get("RENDER_TIMEOUT_SEC", 60))
+RENDER_RETRY_AFTER_SEC = int(os.environ.get("RENDER_RETRY_AFTER_SEC", 2))
+# djvused probes a /books listing may have queued at once, the rest of the
+# queue stays free for /page. each probe holds at most one queue slot
+BOOK_PROBE_CONCURRENCY = int(
+    os.environ.get(
+        "BOOK_PROBE_CONCURRENCY",
+        max(1, min(RENDER_CONCURRENCY, RENDER_QUEUE_SIZE // 2)),
+    )
+)
+# /pages ranges are split into ddjvu runs of at most this many pages so
+# several workers can share a long range
+RANGE_CHUNK_PAGES = int(os.environ.get("RANGE_CHUNK_PAGES", 16))
+RANGE_MAX_PAGES = int(os.environ.get("RANGE_MAX_PAGES", 200))
+# read-ahead: after serving page N, render N+1..N+PREFETCH_PAGES in the background.
+# 0 turns it off
+PREFETCH_PAGES = int(os.environ.get("PREFETCH_PAGES", 0))
+PREFETCH_CONCURRENCY = int(os.environ.get("PREFETCH_CONCURRENCY", 1))
+# output variants (?format=, ?width=, ?dpi=, ?thumb=)
+MAX_WIDTH = int(os.environ.get("MAX_WIDTH", 4000))
+MIN_DPI = int(os.environ.get("MIN_DPI", 25))
+MAX_DPI = int(os.environ.get("MAX_DPI", 600))
+THUMB_WIDTH = int(os.environ.get("THUMB_WIDTH", 200))
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", 80))
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", 75))
+# Cache-Control max-age for plain /page urls. urls carrying ?v= (as handed out
+# by /pages) are immutable instead
+HTTP_MAX_AGE_SEC = int(os.environ.get("HTTP_MAX_AGE_SEC", 86400))
+
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 5 * 1024**3))
+CACHE_POLICY = os.environ.get("CACHE_POLICY", "lru")  # lru | lfu
+# once over budget, evict down to this fraction so we don't evict on every render
+CACHE_LOW_WATERMARK = float(os.environ.get("CACHE_LOW_WATERMARK", 0.9))
+# never evict something touched this recently, it may still be streaming out
+CACHE_EVICT_GRACE_SEC = float(os.environ.get("CACHE_EVICT_GRACE_SEC", 10))
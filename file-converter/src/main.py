@@ -1,30 +1,242 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
-import subprocess
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from email.utils import formatdate, parsedate_to_datetime
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.background import BackgroundTask
+import json
 import os
+import time
 
-app = FastAPI()
+from books import BookMeta, book_index, book_path, page_version, source_stamp
+from cache import page_cache, page_path
+from config import (
+    CACHE_DIR,
+    HTTP_MAX_AGE_SEC,
+    RANGE_MAX_PAGES,
+    RENDER_RETRY_AFTER_SEC,
+)
+import metrics
+from prefetch import prefetcher
+from variants import Variant
+from render import (
+    render_page,
+    render_range,
+    scheduler,
+    RenderError,
+    RenderQueueFull,
+    RenderTimeout,
+)
 
-DJVU_DIR = "/data"
-CACHE_DIR = "/cache"
+app = FastAPI()
 
 os.makedirs(CACHE_DIR, exist_ok=True)
+page_cache.reconcile()
+metrics.watch(scheduler, page_cache)
+# queued read-ahead for an old version of a book is wasted work
+book_index.on_invalidate(prefetcher.cancel)
+
+def _variant(
+    fmt: str = Query(None, alias="format", description="png | jpeg | webp"),
+    width: int = Query(None, ge=1, description="target width in px"),
+    dpi: int = Query(None, ge=1, description="render resolution"),
+    thumb: bool = Query(False, description="thumbnail preset (small webp)"),
+) -> Variant:
+    try:
+        return Variant.from_query(fmt, width, dpi, thumb)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+
+def _stat_book(djvu: str) -> os.stat_result:
+    try:
+        return os.stat(djvu)
+    except FileNotFoundError:
+        raise HTTPException(404, "Book not found")
+
+
+def _render_failed(e: RenderError) -> HTTPException:
+    if isinstance(e, RenderQueueFull):
+        return HTTPException(
+            503,
+            "Too many pages rendering, try again shortly",
+            headers={"Retry-After": str(RENDER_RETRY_AFTER_SEC)},
+        )
+    if isinstance(e, RenderTimeout):
+        return HTTPException(504, "Page render timed out")
+    return HTTPException(500, "Page render failed")
 
-@app.get("/page/{book}/{page}")
-def get_page(book: str, page: int):
-    djvu = f"{DJVU_DIR}/{book}.djvu"
-    out = f"{CACHE_DIR}/{book}_{page}.png"
 
-    if not os.path.exists(djvu):
+async def _book_meta(book: str, st: os.stat_result) -> BookMeta:
+    try:
+        return await book_index.get(book, st)
+    except FileNotFoundError:
         raise HTTPException(404, "Book not found")
+    except RenderError as e:
+        raise _render_failed(e)
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    # If-None-Match wins over If-Modified-Since when both are sent (RFC 9110 13.2.2)
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+        return "*" in tags or etag in tags
+
+    ims = request.headers.get("if-modified-since")
+    if ims is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@app.get("/page/{book}/{page}")
+async def get_page(
+    request: Request,
+    book: str,
+    page: int,
+    variant: Variant = Depends(_variant),
+    v: str = Query(None, description="page version from /pages, makes the response immutable"),
+):
+    t_start = time.perf_counter()
+    djvu = book_path(book)
+    out = page_path(book, page, variant)
+    st = _stat_book(djvu)
+    stamp = source_stamp(st)
+    meta = await _book_meta(book, st)
+
+    if not 1 <= page <= meta.pages:
+        raise HTTPException(404, f"Page not found, {book} has {meta.pages} pages")
+
+    version = page_version(st, page, variant)
+    etag = f'"{version}"'
+    if v == version:
+        # versioned url, a changed book gets a different one
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        cache_control = f"public, max-age={HTTP_MAX_AGE_SEC}"
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stamp, usegmt=True),
+        "Cache-Control": cache_control,
+    }
+
+    # the client already has this exact render, no need to touch the cache at all
+    if _not_modified(request, etag, stamp):
+        return Response(status_code=304, headers=headers)
+
+    t_lookup = time.perf_counter()
+    for attempt in range(2):
+        try:
+            hit = await render_page(djvu, out, page, variant, stamp)
+        except RenderError as e:
+            raise _render_failed(e)
+        try:
+            size = os.path.getsize(out)
+            break
+        except FileNotFoundError:
+            # evicted by someone else's render before we got to send it
+            # (tiny cache, no grace period), render it once more
+            if attempt:
+                raise HTTPException(500, "Page render failed")
+    t_render = time.perf_counter()
+
+    prefetcher.schedule(djvu, book, page, variant, meta.pages, stamp)
+
+    def sent():
+        # background tasks run once the body is out, so this closes the send stage
+        t_sent = time.perf_counter()
+        stages = {
+            "lookup": t_lookup - t_start,  # stat, book index, validators
+            "render": t_render - t_lookup,  # cache lookup on a hit, queue + ddjvu on a miss
+            "send": t_sent - t_render,
+        }
+        for stage, seconds in stages.items():
+            metrics.PAGE_STAGE_SECONDS.labels(stage).observe(seconds)
+        metrics.BYTES_SERVED.labels(variant.fmt).inc(size)
+        metrics.log_timing(
+            event="page",
+            book=book,
+            page=page,
+            variant=variant.key,
+            cache="hit" if hit else "miss",
+            bytes=size,
+            **{f"{stage}_ms": round(seconds * 1000, 2) for stage, seconds in stages.items()},
+        )
+
+    return FileResponse(
+        out,
+        media_type=variant.media_type,
+        headers=headers,
+        background=BackgroundTask(sent),
+    )
+
+
+@app.get("/pages/{book}")
+async def get_pages(
+    book: str,
+    first: int = Query(..., alias="from", ge=1),
+    last: int = Query(..., alias="to", ge=1),
+    variant: Variant = Depends(_variant),
+):
+    """
+    Render a page range into the cache. Streams one ndjson line per page
+    as it lands, each with the url to fetch it from (or the error).
+    """
+    djvu = book_path(book)
+    st = _stat_book(djvu)
+
+    if last < first:
+        raise HTTPException(400, "'to' must not be before 'from'")
+
+    meta = await _book_meta(book, st)
+    if first > meta.pages:
+        raise HTTPException(404, f"Page not found, {book} has {meta.pages} pages")
+    last = min(last, meta.pages)
+    if last - first + 1 > RANGE_MAX_PAGES:
+        raise HTTPException(400, f"At most {RANGE_MAX_PAGES} pages per request")
+
+    # same variant in the urls so they hit what we just cached, plus the
+    # version so they can be cached forever
+    query = variant.query + ("&" if variant.query else "?")
+
+    async def manifest():
+        renders = render_range(djvu, book, first, last, variant, source_stamp(st))
+        async for page, error in renders:
+            v = page_version(st, page, variant)
+            line = {"page": page, "url": f"/page/{book}/{page}{query}v={v}"}
+            if error is not None:
+                line["error"] = str(error)
+            yield json.dumps(line) + "\n"
+
+    return StreamingResponse(manifest(), media_type="application/x-ndjson")
+
+
+@app.get("/books")
+async def list_books():
+    """
+    Every book in the book dir with its page count. Books that couldn't be
+    probed are listed with an "error" instead.
+    """
+    books, errors = await book_index.refresh()
+    listing = [meta.as_dict(sizes=False) for meta in books]
+    listing += [{"name": name, "error": error} for name, error in errors.items()]
+    return sorted(listing, key=lambda b: b["name"])
+
+
+@app.get("/book/{book}")
+async def get_book(book: str):
+    """Page count and per-page pixel size, enough to lay pages out before they load."""
+    st = _stat_book(book_path(book))
+    return (await _book_meta(book, st)).as_dict()
+
+
+@app.get("/cache")
+def cache_stats():
+    return page_cache.stats()
 
-    if not os.path.exists(out):
-        subprocess.run([
-            "ddjvu",
-            "-format=png",
-            f"-page={page}",
-            djvu,
-            out
-        ], check=True)
 
-    return FileResponse(out, media_type="image/png")
+@app.get("/metrics")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
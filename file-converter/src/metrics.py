@@ -0,0 +1,116 @@
+import json
+import logging
+
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+log = logging.getLogger("file-converter")
+if not log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_handler)
+    log.setLevel(logging.INFO)
+
+_MB = 1024**2
+
+RENDER_SECONDS = Histogram(
+    "converter_render_seconds",
+    "Wall time of one ddjvu/djvused run, queue wait excluded",
+    ["tool", "book_size"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+RENDER_QUEUE_WAIT_SECONDS = Histogram(
+    "converter_render_queue_wait_seconds",
+    "Time a job waited for a free render worker",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+RENDER_EXITS = Counter(
+    "converter_render_exits_total",
+    "Finished ddjvu/djvused runs by exit code ('timeout' when we killed it)",
+    ["tool", "code"],
+)
+REJECTED = Counter(
+    "converter_render_rejected_total",
+    "Renders refused with 503 because the queue was full",
+)
+PAGE_STAGE_SECONDS = Histogram(
+    "converter_page_stage_seconds",
+    "Time spent per /page stage",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+BYTES_SERVED = Counter(
+    "converter_bytes_served_total",
+    "Page image bytes sent",
+    ["format"],
+)
+
+
+def book_size_class(size: int) -> str:
+    # coarse buckets, book size is what drives ddjvu time
+    if size < 1 * _MB:
+        return "lt_1mb"
+    if size < 10 * _MB:
+        return "lt_10mb"
+    if size < 100 * _MB:
+        return "lt_100mb"
+    return "ge_100mb"
+
+
+def observe_run(tool: str, book_size: int, seconds: float, code):
+    RENDER_SECONDS.labels(tool, book_size_class(book_size)).observe(seconds)
+    RENDER_EXITS.labels(tool, str(code)).inc()
+
+
+def log_timing(**fields):
+    log.info(json.dumps(fields))
+
+
+class _StateCollector:
+    """Reads live scheduler and cache state at scrape time instead of mirroring it."""
+
+    def __init__(self, scheduler, page_cache):
+        self.scheduler = scheduler
+        self.page_cache = page_cache
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            "converter_renders_in_flight",
+            "ddjvu/djvused processes running",
+            value=self.scheduler.running,
+        )
+        yield GaugeMetricFamily(
+            "converter_render_queue_depth",
+            "Jobs waiting for a render worker",
+            value=self.scheduler.queue_depth,
+        )
+
+        stats = self.page_cache.stats()
+        yield GaugeMetricFamily(
+            "converter_cache_bytes",
+            "Bytes of rendered pages on disk",
+            value=stats["bytes"],
+        )
+        yield GaugeMetricFamily(
+            "converter_cache_entries", "Rendered pages on disk", value=stats["entries"]
+        )
+        lookups = CounterMetricFamily(
+            "converter_cache_lookups", "Page cache lookups", labels=["result"]
+        )
+        lookups.add_metric(["hit"], stats["hits"])
+        lookups.add_metric(["miss"], stats["misses"])
+        yield lookups
+        yield CounterMetricFamily(
+            "converter_cache_evictions",
+            "Pages evicted for space",
+            value=stats["evictions"],
+        )
+        yield CounterMetricFamily(
+            "converter_cache_invalidations",
+            "Pages dropped because the book changed",
+            value=stats["invalidations"],
+        )
+
+
+def watch(scheduler, page_cache):
+    REGISTRY.register(_StateCollector(scheduler, page_cache))
@@ -0,0 +1,111 @@
+import asyncio
+from collections import OrderedDict
+
+from cache import page_cache, page_path
+from config import PREFETCH_CONCURRENCY, PREFETCH_PAGES
+from render import in_flight, scheduler, start_background_render
+from variants import DEFAULT, Variant
+
+
+class Prefetcher:
+    """
+    Read-ahead for page turns. After page N of a book is served, pages
+    N+1..N+depth are queued and rendered one by one whenever the scheduler has a
+    free worker, so prefetch never competes with foreground requests.
+
+    Renders go through the same single-flight and cache as /page, a reader
+    who gets there first just waits for the prefetch (or vice versa).
+    Queuing a new window for a book drops whatever was still pending for
+    its old window, e.g. when the reader jumps elsewhere, and a book that
+    changed or went away drops all of its windows.
+    """
+
+    def __init__(self, depth: int, concurrency: int):
+        self.depth = depth
+        self._concurrency = concurrency
+        self._pending = OrderedDict()  # out -> (djvu, page, variant, not_before)
+        self._windows = {}  # (book, variant) -> outs queued for its latest window
+        self._wake = None
+        self._slots = None
+        self._loop_task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.depth > 0
+
+    def _ensure_started(self):
+        if self._loop_task is not None:
+            return
+        self._wake = asyncio.Event()
+        self._slots = asyncio.Semaphore(self._concurrency)
+        self._loop_task = asyncio.create_task(self._run())
+
+    def schedule(
+        self,
+        djvu: str,
+        book: str,
+        page: int,
+        variant: Variant = DEFAULT,
+        last_page: int = None,
+        not_before: float = 0.0,
+    ):
+        if not self.enabled:
+            return
+        self._ensure_started()
+
+        # read ahead in whatever variant the reader is looking at
+        for out in self._windows.pop((book, variant), ()):
+            self._pending.pop(out, None)
+
+        window = []
+        stop = page + self.depth
+        if last_page is not None:
+            stop = min(stop, last_page)
+        for p in range(page + 1, stop + 1):
+            out = page_path(book, p, variant)
+            if page_cache.has(out, not_before) or in_flight(out):
+                continue
+            self._pending[out] = (djvu, p, variant, not_before)
+            window.append(out)
+
+        if window:
+            self._windows[(book, variant)] = window
+            self._wake.set()
+
+    def cancel(self, book: str = None):
+        """Drop pending prefetches for `book`, or all of them."""
+        for key in list(self._windows):
+            if book is None or key[0] == book:
+                for out in self._windows.pop(key):
+                    self._pending.pop(out, None)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            await self._slots.acquire()
+            await scheduler.wait_idle()
+
+            # the window may have moved while we waited
+            if not self._pending:
+                self._slots.release()
+                continue
+            out, (djvu, page, variant, not_before) = self._pending.popitem(last=False)
+            if page_cache.has(out, not_before) or in_flight(out):
+                self._slots.release()
+                continue
+
+            task = start_background_render(djvu, out, page, variant, not_before)
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Future):
+        self._slots.release()
+        # best effort, a failed prefetch just means the reader renders it later
+        if not task.cancelled():
+            task.exception()
+
+
+prefetcher = Prefetcher(PREFETCH_PAGES, PREFETCH_CONCURRENCY)
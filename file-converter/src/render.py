@@ -0,0 +1,375 @@
+import asyncio
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+from cache import page_cache, page_path
+from metrics import REJECTED, RENDER_QUEUE_WAIT_SECONDS, observe_run
+from variants import DEFAULT, Variant
+from config import (
+    RANGE_CHUNK_PAGES,
+    RENDER_CONCURRENCY,
+    RENDER_QUEUE_SIZE,
+    RENDER_TIMEOUT_SEC,
+)
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderTimeout(RenderError):
+    pass
+
+
+class RenderQueueFull(RenderError):
+    pass
+
+
+class SingleFlight:
+    """
+    Runs a coroutine once per key. Callers that arrive while that key is in
+    flight await the same task and share its result (or its exception).
+    One task may also cover several keys (a page range).
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def get(self, key):
+        return self._tasks.get(key)
+
+    def start(self, keys: list, fn) -> asyncio.Future:
+        task = asyncio.ensure_future(fn())
+        for key in keys:
+            self._tasks[key] = task
+
+        def forget(_):
+            for key in keys:
+                if self._tasks.get(key) is task:
+                    del self._tasks[key]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def do(self, key, fn):
+        task = self._tasks.get(key) or self.start([key], fn)
+        # shield: one client hanging up must not cancel the render for the others
+        return await asyncio.shield(task)
+
+
+PRIORITY_FOREGROUND = 0
+PRIORITY_PREFETCH = 1
+
+
+class RenderScheduler:
+    """
+    Fixed pool of workers pulling ddjvu jobs from a bounded priority queue.
+    At most `concurrency` ddjvu processes run at once, at most `queue_size`
+    jobs wait; anything beyond that is refused with RenderQueueFull.
+    Lower priority value goes first, FIFO within the same priority.
+    """
+
+    def __init__(self, concurrency: int, queue_size: int, timeout: float):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.running = 0
+        self._queue = None
+        self._workers = []
+        self._seq = itertools.count()
+        self._freed = None  # set whenever a worker finishes or skips a job
+
+    def _ensure_started(self):
+        if self._workers:
+            return
+        # created lazily so everything binds to the server's running loop
+        self._queue = asyncio.PriorityQueue(maxsize=self.queue_size)
+        self._freed = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    @property
+    def idle(self) -> bool:
+        """Nothing waiting and at least one worker free."""
+        return self.queue_depth == 0 and self.running < self.concurrency
+
+    async def wait_idle(self):
+        """Return once the scheduler is idle (right away if it already is)."""
+        while not self.idle:
+            self._freed.clear()
+            await self._freed.wait()
+
+    async def submit(
+        self,
+        args: list,
+        priority: int = PRIORITY_FOREGROUND,
+        after=None,
+        book_size: int = 0,
+        timeout: float = None,
+    ):
+        """
+        Run `args` as a subprocess on a worker and return its stdout.
+        `after` is an optional blocking callable (e.g. an image conversion)
+        run in a thread while still holding the worker slot, so it counts
+        against the same cpu budget. `book_size` only labels the timing metric.
+        `timeout` overrides the scheduler's for jobs that do more than one page.
+        """
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        job = (args, after, book_size, timeout or self.timeout, time.monotonic(), fut)
+        try:
+            self._queue.put_nowait((priority, next(self._seq), job))
+        except asyncio.QueueFull:
+            REJECTED.inc()
+            raise RenderQueueFull("render queue is full")
+        return await fut
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            args, after, book_size, timeout, queued_at, fut = job
+            try:
+                if fut.cancelled():
+                    continue
+                RENDER_QUEUE_WAIT_SECONDS.observe(time.monotonic() - queued_at)
+                self.running += 1
+                try:
+                    stdout = await self._run(args, book_size, timeout)
+                    if after is not None:
+                        await asyncio.to_thread(after)
+                finally:
+                    self.running -= 1
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(stdout)
+            finally:
+                self._queue.task_done()
+                self._freed.set()
+
+    async def _run(self, args: list, book_size: int, timeout: float) -> bytes:
+        started = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            observe_run(args[0], book_size, time.monotonic() - started, "timeout")
+            raise RenderTimeout(f"{args[0]} timed out after {timeout}s")
+
+        observe_run(args[0], book_size, time.monotonic() - started, proc.returncode)
+
+        if proc.returncode != 0:
+            raise RenderError(
+                f"{args[0]} exited with {proc.returncode}: "
+                f"{stderr.decode(errors='replace').strip()}"
+            )
+        return stdout
+
+
+scheduler = RenderScheduler(RENDER_CONCURRENCY, RENDER_QUEUE_SIZE, RENDER_TIMEOUT_SEC)
+_renders = SingleFlight()
+
+
+def _tmp_file(near: str) -> str:
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(near), suffix=".tmp")
+    os.close(fd)
+    return tmp
+
+
+async def _render(djvu: str, out: str, page: int, variant: Variant, priority: int):
+    # ddjvu writes into a temp file next to the target, then we rename it in.
+    # same dir -> same filesystem -> os.replace is atomic, readers never see a partial file
+    tmp = _tmp_file(out)
+    raw = _tmp_file(out) if variant.needs_convert else tmp
+    try:
+        await scheduler.submit(
+            ["ddjvu", *variant.ddjvu_args(), f"-page={page}", djvu, raw],
+            priority,
+            after=(lambda: variant.convert(raw, tmp))
+            if variant.needs_convert
+            else None,
+            book_size=os.path.getsize(djvu),
+        )
+        os.replace(tmp, out)
+    finally:
+        for p in {tmp, raw}:
+            if os.path.exists(p):
+                os.remove(p)
+
+
+async def _render_into_cache(
+    djvu: str, out: str, page: int, variant: Variant, priority: int, not_before: float
+) -> str:
+    # re-check inside the flight, a previous leader may have just finished it
+    if not page_cache.has(out, not_before):
+        await _render(djvu, out, page, variant, priority)
+        page_cache.add(out)
+    return out
+
+
+async def render_page(
+    djvu: str, out: str, page: int, variant: Variant = DEFAULT, not_before: float = 0.0
+) -> bool:
+    """
+    Render one page of `djvu` into `out` unless it is already there (and
+    not older than `not_before`). Concurrent calls for the same `out` share
+    a single ddjvu run. Returns True on a cache hit.
+    """
+    if page_cache.lookup(out, not_before):
+        return True
+    await _renders.do(
+        out,
+        lambda: _render_into_cache(
+            djvu, out, page, variant, PRIORITY_FOREGROUND, not_before
+        ),
+    )
+    return False
+
+
+def in_flight(out: str) -> bool:
+    return _renders.get(out) is not None
+
+
+def start_background_render(
+    djvu: str, out: str, page: int, variant: Variant = DEFAULT, not_before: float = 0.0
+) -> asyncio.Future:
+    """
+    Start a low priority render of one page and return its task. It joins
+    the same single-flight as render_page, so a reader asking for that page
+    meanwhile waits for it instead of rendering again.
+    """
+    return _renders.start(
+        [out],
+        lambda: _render_into_cache(
+            djvu, out, page, variant, PRIORITY_PREFETCH, not_before
+        ),
+    )
+
+
+async def _render_chunk(djvu: str, book: str, pages: list, variant: Variant):
+    # one ddjvu for a contiguous run of pages; -eachpage expands %d to the page number
+    first, last = pages[0], pages[-1]
+    tmp_dir = tempfile.mkdtemp(dir=page_cache.root, suffix=".tmp")
+    raw_ext = "png" if not variant.needs_convert else "pnm"
+
+    def raw(page):
+        return os.path.join(tmp_dir, f"{page}.{raw_ext}")
+
+    def done(page):
+        return (
+            raw(page)
+            if not variant.needs_convert
+            else os.path.join(tmp_dir, f"{page}.out")
+        )
+
+    def convert_all():
+        for page in pages:
+            if os.path.exists(raw(page)):
+                variant.convert(raw(page), done(page))
+
+    try:
+        await scheduler.submit(
+            [
+                "ddjvu",
+                *variant.ddjvu_args(),
+                "-eachpage",
+                f"-page={first}-{last}",
+                djvu,
+                os.path.join(tmp_dir, f"%d.{raw_ext}"),
+            ],
+            after=convert_all if variant.needs_convert else None,
+            book_size=os.path.getsize(djvu),
+            # RENDER_TIMEOUT_SEC is per page, a chunk gets it for every page
+            timeout=RENDER_TIMEOUT_SEC * len(pages),
+        )
+        for page in pages:
+            out = page_path(book, page, variant)
+            try:
+                os.replace(done(page), out)
+            except FileNotFoundError:
+                raise RenderError(f"ddjvu produced no output for page {page}")
+            page_cache.add(out)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _chunks(pages: list, size: int):
+    # split into runs that are contiguous and at most `size` long
+    run = []
+    for page in pages:
+        if run and (page != run[-1] + 1 or len(run) >= size):
+            yield run
+            run = []
+        run.append(page)
+    if run:
+        yield run
+
+
+async def render_range(
+    djvu: str,
+    book: str,
+    first: int,
+    last: int,
+    variant: Variant = DEFAULT,
+    not_before: float = 0.0,
+):
+    """
+    Render pages first..last (inclusive) into the cache with as few ddjvu
+    runs as possible. Yields (page, error) as pages become available,
+    error is None on success. Not in page order.
+    """
+    # sort every page out and start the flights before the first yield: the
+    # consumer may take its time, and a flight someone else starts meanwhile
+    # must not be replaced by ours
+    hits = []
+    todo = []
+    waiting = []
+    for page in range(first, last + 1):
+        out = page_path(book, page, variant)
+        if page_cache.lookup(out, not_before):
+            hits.append(page)
+        elif _renders.get(out) is not None:
+            # someone is already on it, piggyback instead of rendering twice
+            waiting.append(([page], asyncio.shield(_renders.get(out))))
+        else:
+            todo.append(page)
+
+    for pages in _chunks(todo, RANGE_CHUNK_PAGES):
+        keys = [page_path(book, p, variant) for p in pages]
+        task = _renders.start(
+            keys, lambda pages=pages: _render_chunk(djvu, book, pages, variant)
+        )
+        waiting.append((pages, asyncio.shield(task)))
+
+    for page in hits:
+        yield page, None
+
+    async def wait(pages, aw):
+        # anything a chunk raises is that chunk's error, the rest of the
+        # range still streams
+        try:
+            await aw
+            return pages, None
+        except Exception as e:
+            return pages, e
+
+    for done in asyncio.as_completed([wait(p, aw) for p, aw in waiting]):
+        pages, error = await done
+        for page in pages:
+            yield page, error
@@ -0,0 +1,107 @@
+from PIL import Image
+
+from config import MAX_WIDTH, MAX_DPI, MIN_DPI, THUMB_WIDTH, JPEG_QUALITY, WEBP_QUALITY
+
+MEDIA_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+# ddjvu fits the page into -size=WxH keeping the aspect ratio, so a huge
+# height bound effectively means "this wide"
+_UNBOUNDED = 100000
+
+
+class Variant:
+    """
+    How a page gets rendered: output format plus at most one of a target
+    width (px) or a resolution (dpi). The default variant is the original
+    full resolution png.
+    """
+
+    __slots__ = ("fmt", "width", "dpi")
+
+    def __init__(self, fmt: str = "png", width: int = None, dpi: int = None):
+        if fmt not in MEDIA_TYPES:
+            raise ValueError(f"unsupported format: {fmt}")
+        if width is not None and dpi is not None:
+            raise ValueError("pass either width or dpi, not both")
+        if width is not None and not 1 <= width <= MAX_WIDTH:
+            raise ValueError(f"width must be between 1 and {MAX_WIDTH}")
+        if dpi is not None and not MIN_DPI <= dpi <= MAX_DPI:
+            raise ValueError(f"dpi must be between {MIN_DPI} and {MAX_DPI}")
+        self.fmt = fmt
+        self.width = width
+        self.dpi = dpi
+
+    @classmethod
+    def from_query(
+        cls, fmt: str = None, width: int = None, dpi: int = None, thumb: bool = False
+    ) -> "Variant":
+        if thumb:
+            if dpi is not None:
+                raise ValueError("thumb already sets the size, drop dpi")
+            return cls(fmt or "webp", width or THUMB_WIDTH)
+        return cls(fmt or "png", width, dpi)
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.fmt]
+
+    @property
+    def key(self) -> str:
+        """Cache file suffix, e.g. '.png' for the default, '_w200.webp' for a thumb."""
+        size = ""
+        if self.width is not None:
+            size = f"_w{self.width}"
+        elif self.dpi is not None:
+            size = f"_d{self.dpi}"
+        return f"{size}.{self.fmt}"
+
+    @property
+    def query(self) -> str:
+        """Query string that asks for this variant again, '' for the default."""
+        params = []
+        if self.fmt != "png":
+            params.append(f"format={self.fmt}")
+        if self.width is not None:
+            params.append(f"width={self.width}")
+        if self.dpi is not None:
+            params.append(f"dpi={self.dpi}")
+        return "?" + "&".join(params) if params else ""
+
+    def ddjvu_args(self) -> list:
+        # png straight from ddjvu, everything else goes through pnm + pillow
+        args = ["-format=png" if self.fmt == "png" else "-format=pnm"]
+        if self.width is not None:
+            args.append(f"-size={self.width}x{_UNBOUNDED}")
+        elif self.dpi is not None:
+            args.append(f"-scale={self.dpi}")
+        return args
+
+    @property
+    def needs_convert(self) -> bool:
+        return self.fmt != "png"
+
+    def convert(self, src: str, dst: str):
+        """pnm from ddjvu -> target format. Blocking, run it off the loop."""
+        with Image.open(src) as im:
+            # bitonal scans come out as pbm, jpeg/webp want L or RGB
+            im = im.convert("L" if im.mode in ("1", "L") else "RGB")
+            if self.fmt == "jpeg":
+                im.save(dst, "JPEG", quality=JPEG_QUALITY, optimize=True)
+            else:
+                im.save(dst, "WEBP", quality=WEBP_QUALITY, method=4)
+
+    def __eq__(self, other):
+        return isinstance(other, Variant) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"Variant({self.key!r})"
+
+
+DEFAULT = Variant()
@@ -0,0 +1,302 @@
+"""
+Where the time goes in a transcription, stage by stage, on the cpu. Runs the
+same steps POST /transcribe does (spool, hash, extract_audio, model load,
+transcribe, srt) in-process, every model/compute type in a fresh process so
+load time and peak RSS aren't skewed by the previous one.
+
+    python bench.py                                   # tiny int8, 30 s of tone, wav
+    python bench.py --sizes tiny,base,small --compute-types int8,float32
+    python bench.py --source speech --seconds 120 --format mp4 --json
+
+Sources:
+    tone    harmonic bursts with pauses, no tools needed (whisper mostly hears nothing)
+    speech  espeak-ng reading a stock paragraph over and over, closer to real work
+
+Formats: wav16 (16kHz mono, skips ffmpeg), wav, mp3, mp4 (black video + aac)
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+
+SAMPLE_RATE = 16000
+
+_TEXT = (
+    "The quick brown fox jumps over the lazy dog. "
+    "Subtitles are generated for every video we publish, "
+    "so the service has to keep up with long recordings and short clips alike. "
+)
+
+
+def make_tone(path: Path, seconds: float):
+    import numpy as np
+
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    # a 150 Hz voice-ish stack, on for 2 s, off for 0.5 s
+    sig = sum(np.sin(2 * np.pi * 150 * k * t) / k for k in range(1, 6))
+    sig *= (t % 2.5) < 2.0
+    pcm = (sig / np.abs(sig).max() * 0.5 * 32767).astype("<i2")
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(pcm.tobytes())
+
+
+def make_speech(path: Path, seconds: float, work: Path):
+    espeak = shutil.which("espeak-ng") or shutil.which("espeak")
+    if not espeak:
+        sys.exit("--source speech needs espeak-ng")
+    one = work / "one.wav"
+    subprocess.run([espeak, "-w", str(one), _TEXT], check=True, capture_output=True)
+    # loop it to length and bring it to 16kHz mono in one go
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-y",
+            "-stream_loop",
+            "-1",
+            "-i",
+            str(one),
+            "-t",
+            str(seconds),
+            "-ac",
+            "1",
+            "-ar",
+            str(SAMPLE_RATE),
+            str(path),
+        ],
+        check=True,
+    )
+
+
+def make_input(args, work: Path) -> Path:
+    base = work / "base.wav"
+    if args.source == "speech":
+        make_speech(base, args.seconds, work)
+    else:
+        make_tone(base, args.seconds)
+
+    if args.format == "wav16":
+        return base
+    out = work / f"input.{args.format}"
+    cmd = ["ffmpeg", "-loglevel", "error", "-y"]
+    if args.format == "mp4":
+        cmd += [
+            "-f",
+            "lavfi",
+            "-i",
+            f"color=c=black:s=640x360:r=25:d={args.seconds}",
+            "-i",
+            str(base),
+            "-shortest",
+            "-c:v",
+            "mpeg4",
+            "-c:a",
+            "aac",
+        ]
+    elif args.format == "wav":
+        # what a recorder hands you, has to be resampled + downmixed
+        cmd += ["-i", str(base), "-ar", "44100", "-ac", "2"]
+    else:
+        cmd += ["-i", str(base)]
+    subprocess.run(cmd + [str(out)], check=True)
+    return out
+
+
+def timed(fn, *a):
+    t = time.perf_counter()
+    out = fn(*a)
+    return out, time.perf_counter() - t
+
+
+def child(spec: str, path: Path, repeat: int, language: str) -> dict:
+    """One model/compute type, runs in its own process."""
+    sys.path.insert(0, str(APP_DIR))
+    from tempfile import SpooledTemporaryFile
+
+    from helpers import extract_audio, srt_cue, transcribe_segments
+    from models import lease
+    from result_cache import hash_upload
+
+    size, compute_type = spec.split(":")
+    data = path.read_bytes()
+    ext = path.suffix.lower()
+
+    def spool():
+        # what starlette does with an upload: 1 MB in memory, then a temp file
+        f = SpooledTemporaryFile(max_size=1024 * 1024)
+        f.write(data)
+        f.seek(0)
+        return f
+
+    stages = {k: [] for k in ("spool", "hash", "extract_audio", "transcribe", "srt")}
+    t = time.perf_counter()
+    with lease("cpu", size, compute_type):
+        # cold load, it stays resident for the runs below
+        load_sec = time.perf_counter() - t
+
+    for _ in range(repeat):
+        f, sec = timed(spool)
+        stages["spool"].append(sec)
+        _, sec = timed(hash_upload, f)
+        stages["hash"].append(sec)
+        audio, sec = timed(extract_audio, f, ext)
+        stages["extract_audio"].append(sec)
+        f.close()
+
+        segments, sec = timed(
+            lambda: list(
+                transcribe_segments(audio, language, "cpu", size, compute_type)
+            )
+        )
+        stages["transcribe"].append(sec)
+        _, sec = timed(
+            lambda: "\n".join(
+                srt_cue(n, start, end, text)
+                for n, (start, end, text, _) in enumerate(segments, 1)
+            )
+        )
+        stages["srt"].append(sec)
+
+    audio_sec = len(audio) / SAMPLE_RATE
+    transcribe = statistics.median(stages["transcribe"])
+    return {
+        "model": size,
+        "compute_type": compute_type,
+        "audio_sec": round(audio_sec, 2),
+        "segments": len(segments),
+        "load_ms": round(load_sec * 1000, 1),
+        # first transcribe pays for lazy init, the median doesn't
+        "first_transcribe_ms": round(stages["transcribe"][0] * 1000, 1),
+        **{f"{k}_ms": round(statistics.median(v) * 1000, 2) for k, v in stages.items()},
+        "rtf": round(transcribe / audio_sec, 4) if audio_sec else None,
+        # linux reports KB
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def print_table(rows: list):
+    cols = (
+        "load_ms",
+        "spool_ms",
+        "hash_ms",
+        "extract_audio_ms",
+        "first_transcribe_ms",
+        "transcribe_ms",
+        "srt_ms",
+        "rtf",
+        "peak_rss_mb",
+    )
+    print(f"{'model':<18}" + "".join(f"{c.replace('_ms', ''):>17}" for c in cols))
+    for r in rows:
+        if "error" in r:
+            print(f"{r['spec']:<18}  {r['error']}")
+            continue
+        name = f"{r['model']}/{r['compute_type']}"
+        print(f"{name:<18}" + "".join(f"{r[c]:>17}" for c in cols))
+    if rows and "audio_sec" in rows[0]:
+        print(
+            f"\n{rows[0]['audio_sec']} s of audio, times in ms (medians), rtf = transcribe / audio"
+        )
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    ap.add_argument("--sizes", default="tiny", help="comma separated model sizes")
+    ap.add_argument(
+        "--compute-types", default="int8", help="comma separated cpu compute types"
+    )
+    ap.add_argument("--seconds", type=float, default=30)
+    ap.add_argument("--source", choices=("tone", "speech"), default="tone")
+    ap.add_argument("--format", choices=("wav16", "wav", "mp3", "mp4"), default="wav")
+    ap.add_argument(
+        "--repeat", type=int, default=3, help="runs per stage, medians are reported"
+    )
+    ap.add_argument("--language", default="en")
+    ap.add_argument("--json", action="store_true", help="print results as json")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    ap.add_argument("--input", help=argparse.SUPPRESS)
+    args, extra_env = ap.parse_known_args()
+
+    if args.child:
+        print(
+            json.dumps(child(args.child, Path(args.input), args.repeat, args.language))
+        )
+        return
+
+    work = Path(tempfile.mkdtemp(prefix="caption-bench-"))
+    # the app reads env at import. keep the result cache out of the way and
+    # long audio on the plain path; KEY=VALUE on the command line overrides
+    env = dict(
+        os.environ,
+        RESULT_CACHE_DIR=str(work / "results"),
+        CHUNK_WORKERS="1",
+        MODEL_PRELOAD="",
+        MODEL_PINNED="",
+    )
+    for kv in extra_env:
+        key, _, value = kv.partition("=")
+        env[key] = value
+
+    rows = []
+    try:
+        path = make_input(args, work)
+        for size in args.sizes.split(","):
+            for compute_type in args.compute_types.split(","):
+                spec = f"{size}:{compute_type}"
+                if not args.json:
+                    print(f"running {spec}...", file=sys.stderr)
+                proc = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--child",
+                        spec,
+                        "--input",
+                        str(path),
+                        "--repeat",
+                        str(args.repeat),
+                        "--language",
+                        args.language,
+                    ],
+                    env=env,
+                    cwd=APP_DIR,
+                    capture_output=True,
+                    text=True,
+                )
+                if proc.returncode != 0:
+                    lines = proc.stderr.strip().splitlines() or [
+                        "exit code %d" % proc.returncode
+                    ]
+                    rows.append({"spec": spec, "error": lines[-1]})
+                else:
+                    rows.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import bisect
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from faster_whisper import BatchedInferencePipeline
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+from models import device_slot, lease, record_inference
+
+# concurrent jobs on the same model get decoded together: whoever arrives
+# within the window rides along in one BatchedInferencePipeline run
+BATCH_DEVICES = set(filter(None, os.environ.get("BATCH_DEVICES", "cuda").split(",")))
+BATCH_WINDOW_SEC = float(os.environ.get("BATCH_WINDOW_MS", 50)) / 1000
+BATCH_MAX_REQUESTS = int(os.environ.get("BATCH_MAX_REQUESTS", 8))
+# 30 s clips decoded per forward pass
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 8))
+# longer audio runs alone, a 2 h file shouldn't hold short clips hostage
+BATCH_MAX_AUDIO_SEC = float(os.environ.get("BATCH_MAX_AUDIO_SEC", 600))
+
+SAMPLE_RATE = 16000
+# whisper's window, a clip can't be longer
+_CLIP_SEC = 30.0
+
+_DONE = object()
+
+_BATCHERS = {}
+_BATCHERS_LOCK = threading.Lock()
+
+
+def enabled(device: str) -> bool:
+    return device in BATCH_DEVICES
+
+
+def _speech_clips(audio: np.ndarray) -> list:
+    """
+    Speech in `audio` as (start, end) seconds, neighbours merged up to 30 s.
+    Same vad settings BatchedInferencePipeline would use on its own.
+    """
+    speech = get_speech_timestamps(
+        audio,
+        VadOptions(max_speech_duration_s=_CLIP_SEC, min_silence_duration_ms=160),
+        sampling_rate=SAMPLE_RATE,
+    )
+    clips = []
+    for ts in speech:
+        start, end = ts["start"] / SAMPLE_RATE, ts["end"] / SAMPLE_RATE
+        if clips and end - clips[-1][0] <= _CLIP_SEC:
+            clips[-1] = (clips[-1][0], end)
+        else:
+            clips.append((start, end))
+    return clips
+
+
+class _Request:
+    def __init__(self, audio: np.ndarray, language: str, clips: list):
+        self.audio = audio
+        self.language = language
+        self.clips = clips
+        self.duration = len(audio) / SAMPLE_RATE
+        # (start, end, text) as decoded, then _DONE or an exception
+        self.out = queue.SimpleQueue()
+
+
+class Batcher:
+    """
+    One per loaded model. Collects requests for BATCH_WINDOW_SEC after the
+    first one shows up, glues the audio of those sharing a language together
+    and hands the speech clips to BatchedInferencePipeline as
+    clip_timestamps. Clips never straddle two requests, so every segment
+    that comes back belongs to exactly one caller.
+    """
+
+    def __init__(self, device: str, size: str, compute_type: str):
+        self.device = device
+        self.size = size
+        self.compute_type = compute_type
+        self.batches = 0
+        self.batched_requests = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        threading.Thread(
+            target=self._loop, daemon=True, name=f"batch-{size}-{device}"
+        ).start()
+
+    def submit(self, req: _Request):
+        with self._cond:
+            self._pending.append(req)
+            self._cond.notify()
+
+    def _take(self) -> list:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = time.monotonic() + BATCH_WINDOW_SEC
+            while len(self._pending) < BATCH_MAX_REQUESTS:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+
+            # oldest request decides the language, the rest wait their turn
+            language = self._pending[0].language
+            batch, rest, total = [], [], 0.0
+            for req in self._pending:
+                fits = not batch or total + req.duration <= BATCH_MAX_AUDIO_SEC
+                if (
+                    req.language == language
+                    and len(batch) < BATCH_MAX_REQUESTS
+                    and fits
+                ):
+                    batch.append(req)
+                    total += req.duration
+                else:
+                    rest.append(req)
+            self._pending = rest
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._take()
+            try:
+                self._run(batch)
+            except Exception as e:
+                for req in batch:
+                    req.out.put(e)
+            else:
+                for req in batch:
+                    req.out.put(_DONE)
+
+    def _run(self, batch: list):
+        offsets, clips, t = [], [], 0.0
+        for req in batch:
+            offsets.append(t)
+            clips += [{"start": t + s, "end": t + e} for s, e in req.clips]
+            t += req.duration
+        audio = np.concatenate([req.audio for req in batch])
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+
+        with (
+            device_slot(self.device),
+            lease(self.device, self.size, self.compute_type) as model,
+        ):
+            t0 = time.perf_counter()
+            try:
+                segments, _ = BatchedInferencePipeline(model).transcribe(
+                    audio,
+                    language=batch[0].language,
+                    clip_timestamps=clips,
+                    without_timestamps=False,  # subtitles want real segment times
+                    batch_size=BATCH_SIZE,
+                )
+                for seg in segments:
+                    i = bisect.bisect_right(offsets, seg.start) - 1
+                    offset = offsets[i]
+                    batch[i].out.put(
+                        (seg.start - offset, seg.end - offset, seg.text.strip())
+                    )
+            finally:
+                record_inference(
+                    self.device,
+                    self.size,
+                    self.compute_type,
+                    time.perf_counter() - t0,
+                    t,
+                )
+
+
+def _batcher(device: str, size: str, compute_type: str) -> Batcher:
+    key = (size, device, compute_type)
+    with _BATCHERS_LOCK:
+        if key not in _BATCHERS:
+            _BATCHERS[key] = Batcher(device, size, compute_type)
+        return _BATCHERS[key]
+
+
+def transcribe_batched(
+    audio: np.ndarray, language: str, device: str, size: str, compute_type: str
+):
+    """
+    Same contract as helpers.transcribe_segments, but the decoding happens
+    on the model's batcher thread together with whatever else is in flight.
+    """
+    if language is None:
+        # batches share one language, so find out ours up front
+        with device_slot(device), lease(device, size, compute_type) as model:
+            language, _, _ = model.detect_language(audio)
+
+    clips = _speech_clips(audio)
+    if not clips:
+        return
+
+    req = _Request(audio, language, clips)
+    _batcher(device, size, compute_type).submit(req)
+    while True:
+        item = req.out.get()
+        if item is _DONE:
+            return
+        if isinstance(item, Exception):
+            raise item
+        start, end, text = item
+        progress = min(end / req.duration, 1.0) if req.duration else 0.0
+        yield start, end, text, progress
+
+
+def batch_stats() -> list:
+    with _BATCHERS_LOCK:
+        return [
+            {
+                "model": b.size,
+                "device": b.device,
+                "compute_type": b.compute_type,
+                "batches": b.batches,
+                "requests": b.batched_requests,
+                "pending": len(b._pending),
+            }
+            for b in _BATCHERS.values()
+        ]
@@ -0,0 +1,240 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from faster_whisper import WhisperModel
+from faster_whisper.vad import get_speech_timestamps
+
+from models import (
+    MODEL_MEMORY_BUDGET_MB,
+    acquire_slot,
+    add_replicas,
+    model_memory_mb,
+    record_inference,
+    release_slot,
+    remove_replicas,
+)
+
+# long cpu audio gets cut at silences and spread over a pool of model
+# replicas (separate processes, ctranslate2 doesn't scale one instance
+# past a handful of threads). the replicas count against the cpu memory
+# budget like loaded models, every running chunk takes a cpu inference slot
+CHUNK_CPU_THREADS = int(os.environ.get("CHUNK_CPU_THREADS", 4))
+CHUNK_WORKERS = int(
+    os.environ.get("CHUNK_WORKERS", max(1, (os.cpu_count() or 1) // CHUNK_CPU_THREADS))
+)
+CHUNKED_MIN_SEC = float(os.environ.get("CHUNKED_MIN_SEC", 600))
+CHUNK_SEC = float(os.environ.get("CHUNK_SEC", 300))
+CHUNK_POOL_IDLE_SEC = float(os.environ.get("CHUNK_POOL_IDLE_SEC", 300))
+
+SAMPLE_RATE = 16000
+
+# a cut has to land in a pause at least this long, else we hard cut
+_MIN_GAP_SEC = 0.3
+
+_POOL = None
+_POOL_SPEC = None
+_POOL_SPECS = {}  # pool -> (size, compute_type, workers), detached ones included
+_POOL_BUSY = {}  # pool -> transcriptions using it
+_POOL_TIMER = None
+_POOL_LOCK = threading.Lock()
+
+# per worker process
+_worker_model = None
+
+
+def _workers(size: str, compute_type: str) -> int:
+    # no more replicas than the cpu budget holds, else add_replicas would
+    # evict everything and still be over
+    fit = MODEL_MEMORY_BUDGET_MB["cpu"] // model_memory_mb(size, compute_type)
+    return max(1, min(CHUNK_WORKERS, fit))
+
+
+def enabled(audio: np.ndarray, size: str, compute_type: str) -> bool:
+    # a single replica is no faster than the plain path
+    long_enough = len(audio) >= CHUNKED_MIN_SEC * SAMPLE_RATE
+    return long_enough and _workers(size, compute_type) > 1
+
+
+def split_at_silences(audio: np.ndarray, chunk_sec: float = CHUNK_SEC) -> list:
+    """
+    Cut points (sample offsets, first is 0, last is len(audio)) so that every
+    chunk is at most ~1.5 * chunk_sec long and, where possible, ends in the
+    middle of a pause nobody is talking in.
+    """
+    speech = get_speech_timestamps(audio, sampling_rate=SAMPLE_RATE)
+    min_gap = int(_MIN_GAP_SEC * SAMPLE_RATE)
+    gaps = [
+        (a["end"] + b["start"]) // 2
+        for a, b in zip(speech, speech[1:])
+        if b["start"] - a["end"] >= min_gap
+    ]
+
+    target = int(chunk_sec * SAMPLE_RATE)
+    cuts = [0]
+    while len(audio) - cuts[-1] > target * 1.5:
+        lo, hi = cuts[-1] + target // 2, cuts[-1] + target * 3 // 2
+        candidates = [g for g in gaps if lo <= g <= hi]
+        if candidates:
+            # the pause closest to the target length
+            cut = min(candidates, key=lambda g: abs(g - cuts[-1] - target))
+        else:
+            cut = cuts[-1] + target
+        cuts.append(cut)
+    cuts.append(len(audio))
+    return cuts
+
+
+def _init_worker(size: str, compute_type: str, cpu_threads: int):
+    global _worker_model
+    _worker_model = WhisperModel(
+        size,
+        device="cpu",
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        num_workers=1,
+    )
+
+
+def _transcribe_chunk(audio: np.ndarray, language: str):
+    t0 = time.perf_counter()
+    segments, info = _worker_model.transcribe(audio, language=language, vad_filter=True)
+    segments = [(s.start, s.end, s.text.strip()) for s in segments]
+    return segments, info.language, time.perf_counter() - t0
+
+
+def _shutdown_pool(pool: ProcessPoolExecutor):
+    # under _POOL_LOCK
+    size, compute_type, workers = _POOL_SPECS.pop(pool)
+    pool.shutdown(wait=False, cancel_futures=True)
+    remove_replicas("cpu", size, compute_type, workers)
+
+
+def _acquire_pool(size: str, compute_type: str) -> ProcessPoolExecutor:
+    global _POOL, _POOL_SPEC, _POOL_TIMER
+    with _POOL_LOCK:
+        if _POOL_TIMER is not None:
+            _POOL_TIMER.cancel()
+            _POOL_TIMER = None
+        if _POOL is not None and _POOL_SPEC != (size, compute_type):
+            # other model wanted, the old pool goes away once its users are done
+            if not _POOL_BUSY.get(_POOL):
+                _shutdown_pool(_POOL)
+            _POOL = None
+        if _POOL is None:
+            workers = _workers(size, compute_type)
+            # spawn, forking a process full of threads is asking for trouble
+            _POOL = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(size, compute_type, CHUNK_CPU_THREADS),
+            )
+            _POOL_SPEC = (size, compute_type)
+            _POOL_SPECS[_POOL] = (size, compute_type, workers)
+            add_replicas("cpu", size, compute_type, workers)
+        _POOL_BUSY[_POOL] = _POOL_BUSY.get(_POOL, 0) + 1
+        return _POOL
+
+
+def _release_pool(pool: ProcessPoolExecutor, broken: bool = False):
+    global _POOL, _POOL_TIMER
+    with _POOL_LOCK:
+        _POOL_BUSY[pool] -= 1
+        if _POOL_BUSY[pool]:
+            return
+        del _POOL_BUSY[pool]
+        if broken and _POOL is pool:
+            _POOL = None
+        if _POOL is not pool:
+            _shutdown_pool(pool)
+        elif _POOL_TIMER is None:
+            # replicas hold a model each, give the memory back when idle
+            _POOL_TIMER = threading.Timer(CHUNK_POOL_IDLE_SEC, _shutdown_idle_pool)
+            _POOL_TIMER.daemon = True
+            _POOL_TIMER.start()
+
+
+def _shutdown_idle_pool():
+    global _POOL, _POOL_TIMER
+    with _POOL_LOCK:
+        if _POOL is None or _POOL in _POOL_BUSY:
+            return
+        _shutdown_pool(_POOL)
+        _POOL, _POOL_TIMER = None, None
+
+
+def transcribe_chunked(audio: np.ndarray, language: str, size: str, compute_type: str):
+    """
+    Same contract as helpers.transcribe_segments: yields (start, end, text,
+    progress) in order, with the chunk offsets already added. Chunks go to
+    the pool as cpu slots free up (a feeder thread waits for them), results
+    are handed out as the earliest unfinished chunk completes. Closing the
+    generator drops pending chunks.
+    """
+    cuts = split_at_silences(audio)
+    duration = len(audio) / SAMPLE_RATE
+    chunks = [audio[a:b] for a, b in zip(cuts, cuts[1:])]
+    pool = _acquire_pool(size, compute_type)
+    submitted = queue.SimpleQueue()  # futures in chunk order, or the feeder's exception
+    futures = []
+    stop = threading.Event()
+    submit_lock = threading.Lock()
+
+    def feed():
+        lang = language
+        try:
+            for chunk in chunks:
+                # the slot is released when the chunk is done (or cancelled)
+                while not acquire_slot("cpu", timeout=0.5):
+                    if stop.is_set():
+                        return
+                with submit_lock:
+                    if stop.is_set():
+                        release_slot("cpu")
+                        return
+                    try:
+                        fut = pool.submit(_transcribe_chunk, chunk, lang)
+                    except BaseException:
+                        release_slot("cpu")
+                        raise
+                    futures.append(fut)
+                fut.add_done_callback(lambda _: release_slot("cpu"))
+                submitted.put(fut)
+                if lang is None:
+                    # detect once on the first chunk, else every chunk guesses for itself.
+                    # if it fails the consumer hits that on this future first
+                    _, lang, _ = fut.result()
+        except BaseException as e:
+            submitted.put(e)
+
+    threading.Thread(target=feed, daemon=True, name="chunk-feeder").start()
+
+    broken = False
+    try:
+        for offset, chunk_end in zip(cuts, cuts[1:]):
+            fut = submitted.get()
+            if isinstance(fut, BaseException):
+                raise fut
+            segments, _, busy = fut.result()
+            record_inference(
+                "cpu", size, compute_type, busy, (chunk_end - offset) / SAMPLE_RATE
+            )
+            offset /= SAMPLE_RATE
+            for start, end, text in segments:
+                progress = min((offset + end) / duration, 1.0) if duration else 0.0
+                yield offset + start, offset + end, text, progress
+    except BrokenProcessPool:
+        broken = True
+        raise
+    finally:
+        with submit_lock:
+            stop.set()
+            for fut in futures:
+                fut.cancel()
+        _release_pool(pool, broken)
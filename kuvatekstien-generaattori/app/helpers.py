@@ -1,156 +1,207 @@
-import subprocess
 import os
-import tempfile
-import gc
-import time
+import subprocess
+import shutil
 import threading
+import time
+import wave
 
-from faster_whisper import WhisperModel
-
-# uses one context to avoid repeated model loading
-_MODELS = {}
+import numpy as np
 
-# on idle unload
-_MODEL_LAST_USED = {}
-_MODEL_LOCK = threading.Lock()
-_SWEEPER_STARTED = False
-_MODEL_IDLE_TIMEOUT_SEC = 30.0
-_SWEEP_INTERVAL_SEC = 2.0
+import batching
+import chunked
+from models import device_slot, lease, model_spec, record_inference
 
 SUPPORTED_VIDEO_EXTENSIONS = {
     ".mp4", ".mkv", ".avi", ".flv", ".mov", ".webm", ".mpg", ".mpeg"
 }
+SUPPORTED_AUDIO_EXTENSIONS = {".wav", ".mp3", ".m4a", ".flac", ".opus"}
+SUPPORTED_EXTENSIONS = SUPPORTED_VIDEO_EXTENSIONS | SUPPORTED_AUDIO_EXTENSIONS
 
+# index (moov atom) may sit at the end of the file -> ffmpeg has to seek,
+# a pipe won't do. everything else decodes fine front to back from stdin
+SEEKABLE_ONLY_EXTENSIONS = {".mp4", ".mov", ".m4a"}
 
-def extract_audio(video_path: str) -> str:
-    """
-    Extract mono 16kHz WAV audio from video using ffmpeg.
-    Returns path to wav file.
-    """
-    wav_fd, wav_path = tempfile.mkstemp(suffix=".wav")
-    os.close(wav_fd)
+SAMPLE_RATE = 16000
+_PIPE_CHUNK = 1024 * 1024
 
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-i", video_path,
-        "-ac", "1",
-        "-ar", "16000",
-        "-vn",
-        wav_path
-    ]
-
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-    return wav_path
+# ffmpeg decoder threads, 0 = let ffmpeg pick
+FFMPEG_THREADS = os.environ.get("FFMPEG_THREADS", "0")
 
 
-def _maybe_empty_cuda_cache():
+def _feed(src, dst):
+    # pump the upload into ffmpeg's stdin, ffmpeg may quit early on bad input
     try:
-        import torch
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-    except Exception:
+        shutil.copyfileobj(src, dst, _PIPE_CHUNK)
+    except (BrokenPipeError, ValueError):
         pass
+    finally:
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
 
 
-def _unload_model(device: str):
-    # Remove cached model and force cleanup.
-    with _MODEL_LOCK:
-        model = _MODELS.pop(device, None)
-        _MODEL_LAST_USED.pop(device, None)
-
-    if model is not None:
-        # Drop reference + collect garbage to encourage VRAM release.
-        del model
-        gc.collect()
-        if device == "cuda":
-            _maybe_empty_cuda_cache()
-
-
-def _sweeper_loop():
-    while True:
-        now = time.monotonic()
-        to_unload = []
-
-        with _MODEL_LOCK:
-            for device, last_used in list(_MODEL_LAST_USED.items()):
-                if (now - last_used) >= _MODEL_IDLE_TIMEOUT_SEC:
-                    to_unload.append(device)
-
-        for device in to_unload:
-            _unload_model(device)
-
-        time.sleep(_SWEEP_INTERVAL_SEC)
-
-
-def _ensure_sweeper_started():
-    global _SWEEPER_STARTED
-    with _MODEL_LOCK:
-        if _SWEEPER_STARTED:
-            return
-        
-        # daemon sweeper thread 
-        t = threading.Thread(target=_sweeper_loop, daemon=True)
-        t.start()
-        _SWEEPER_STARTED = True
-
-
-def get_model(device: str):
-    _ensure_sweeper_started()
-
-    with _MODEL_LOCK:
-        if device not in _MODELS:
-            if device == "cuda":
-                _MODELS[device] = WhisperModel(
-                    "medium",
-                    device="cuda",
-                    compute_type="float16"
-                )
-            else:
-                _MODELS[device] = WhisperModel(
-                    "medium",
-                    device="cpu",
-                    compute_type="int8"
-                )
-
-    # mark as used whenever fetched
-    _MODEL_LAST_USED[device] = time.monotonic()
-    return _MODELS[device]
-
-
-def transcribe_to_srt(audio_path: str, language: str, device: str) -> str:
+def _read_pcm_wav(src, start: float = None, end: float = None):
     """
-    Transcribe audio and return SRT content as string.
+    The samples of a wav that already is 16kHz mono s16, straight off the
+    spool. None for anything else, that goes through ffmpeg.
+    """
+    src.seek(0)
+    try:
+        w = wave.open(src, "rb")
+    except (wave.Error, EOFError):
+        return None
+    with w:
+        if (w.getnchannels(), w.getframerate(), w.getsampwidth()) != (1, SAMPLE_RATE, 2):
+            return None
+        first = int((start or 0) * SAMPLE_RATE)
+        last = w.getnframes() if end is None else min(int(end * SAMPLE_RATE), w.getnframes())
+        if first >= last:
+            return np.zeros(0, dtype=np.float32)
+        w.setpos(first)
+        pcm = w.readframes(last - first)
+    return np.frombuffer(pcm, dtype="<i2").astype(np.float32) / 32768.0
+
+
+def extract_audio(src, ext: str, start: float = None, end: float = None) -> np.ndarray:
     """
-    model = get_model(device)
+    Decode the audio track of an upload to mono 16kHz float32 PCM, in memory.
+    `src` is the upload's file object (a SpooledTemporaryFile from starlette).
+    Streamable containers are piped into ffmpeg's stdin; mp4/mov/m4a get the
+    spool itself as a seekable file, no extra copy either way. A wav that
+    is 16kHz mono already skips ffmpeg. `start`/`end` (seconds) trim.
+    """
+    if ext == ".wav":
+        audio = _read_pcm_wav(src, start, end)
+        if audio is not None:
+            return audio
+
+    src.seek(0)
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-threads", FFMPEG_THREADS]
+    pass_fds = ()
+
+    trim = []
+    if start:
+        trim += ["-ss", str(start)]
+    if end is not None:
+        trim += ["-t", str(end - (start or 0))]
+
+    if ext in SEEKABLE_ONLY_EXTENSIONS:
+        # make sure the spool is on disk, then let ffmpeg open it via /dev/fd
+        if hasattr(src, "rollover"):
+            src.rollover()
+        fd = src.fileno()
+        pass_fds = (fd,)
+        # seekable: trim as input options, ffmpeg jumps there instead of decoding up to it
+        cmd += trim + ["-i", f"/dev/fd/{fd}"]
+    else:
+        # a pipe can't seek, input side -ss lands off by whole packets there.
+        # as output options it decodes from the top and drops, but exactly
+        cmd += ["-i", "pipe:0"] + trim
+
+    cmd += [
+        # first audio stream only, video never gets decoded
+        "-map", "0:a:0",
+        "-ac", "1",
+        "-ar", str(SAMPLE_RATE),
+        "-f", "s16le",
+        "pipe:1"
+    ]
 
-    segments, _ = model.transcribe(
-        audio_path,
-        language=language, # None -> autodetect
-        vad_filter=True
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL if pass_fds else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        pass_fds=pass_fds,
     )
 
-    with _MODEL_LOCK:
-        _MODEL_LAST_USED[device] = time.monotonic()
-
-    def format_timestamp(seconds: float) -> str:
-        ms = int((seconds % 1) * 1000)
-        s = int(seconds) % 60
-        m = int(seconds // 60) % 60
-        h = int(seconds // 3600)
-        return f"{h:02}:{m:02}:{s:02},{ms:03}"
-
-    srt_lines = []
-    for i, seg in enumerate(segments, start=1):
-        start = format_timestamp(seg.start)
-        end = format_timestamp(seg.end)
-        text = seg.text.strip()
-
-        srt_lines.extend([
-            str(i),
-            f"{start} --> {end}",
-            text,
-            ""
-        ])
-
-    return "\n".join(srt_lines)
+    feeder = None
+    if not pass_fds:
+        feeder = threading.Thread(target=_feed, args=(src, proc.stdin), daemon=True)
+        feeder.start()
+
+    pcm = proc.stdout.read()
+    proc.wait()
+    if feeder is not None:
+        feeder.join()
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def format_timestamp(seconds: float, sep: str = ",") -> str:
+    # srt wants 00:00:01,000, webvtt 00:00:01.000
+    ms = int((seconds % 1) * 1000)
+    s = int(seconds) % 60
+    m = int(seconds // 60) % 60
+    h = int(seconds // 3600)
+    return f"{h:02}:{m:02}:{s:02}{sep}{ms:03}"
+
+
+def srt_cue(index: int, start: float, end: float, text: str) -> str:
+    return f"{index}\n{format_timestamp(start)} --> {format_timestamp(end)}\n{text}\n"
+
+
+def vtt_cue(start: float, end: float, text: str) -> str:
+    return f"{format_timestamp(start, '.')} --> {format_timestamp(end, '.')}\n{text}\n"
+
+
+def transcribe_segments(audio: np.ndarray, language: str, device: str,
+                        size: str = None, compute_type: str = None):
+    """
+    Lazily transcribe 16kHz mono PCM (or a path to an audio file).
+    Yields (start, end, text, progress) as faster-whisper decodes, progress
+    being how far into the audio (0..1) that segment ends.
+    Long audio on cpu is split and spread over the chunked replica pool,
+    on batching devices the model's batcher does the decoding.
+    """
+    size, compute_type = model_spec(device, size, compute_type)
+    if device == "cpu" and isinstance(audio, np.ndarray) and chunked.enabled(audio, size, compute_type):
+        yield from chunked.transcribe_chunked(audio, language, size, compute_type)
+        return
+    if batching.enabled(device) and isinstance(audio, np.ndarray):
+        yield from batching.transcribe_batched(audio, language, device, size, compute_type)
+        return
+
+    # queue for the device, then hold the model until the last segment is out
+    with device_slot(device), lease(device, size, compute_type) as model:
+        # only the time spent inside the model counts, not the consumer's
+        t0 = time.perf_counter()
+        segments, info = model.transcribe(
+            audio,
+            language=language, # None -> autodetect
+            vad_filter=True
+        )
+        busy = time.perf_counter() - t0
+
+        try:
+            while True:
+                t0 = time.perf_counter()
+                seg = next(segments, None)
+                busy += time.perf_counter() - t0
+                if seg is None:
+                    break
+                progress = min(seg.end / info.duration, 1.0) if info.duration else 0.0
+                yield seg.start, seg.end, seg.text.strip(), progress
+        finally:
+            record_inference(device, size, compute_type, busy, info.duration)
+
+
+def transcribe_to_srt(audio: np.ndarray, language: str, device: str,
+                      on_progress=None, size: str = None, compute_type: str = None) -> str:
+    """
+    Transcribe 16kHz mono PCM (or a path to an audio file) and return SRT content as string.
+    `on_progress(fraction)` is called after every segment; raising from it aborts.
+    """
+    cues = []
+    for i, (start, end, text, progress) in enumerate(
+        transcribe_segments(audio, language, device, size, compute_type), start=1
+    ):
+        cues.append(srt_cue(i, start, end, text))
+        if on_progress is not None:
+            on_progress(progress)
+
+    return "\n".join(cues)
@@ -0,0 +1,393 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import metrics
+from helpers import (
+    SAMPLE_RATE,
+    SUPPORTED_AUDIO_EXTENSIONS,
+    extract_audio,
+    srt_cue,
+    transcribe_segments,
+)
+from result_cache import hash_upload, result_cache, result_key
+
+# transcriptions allowed to run at once, per device. on cuda jobs on the
+# same model are decoded in one batch (see batching.py), so a few at once
+# fill the batch instead of fighting over VRAM
+MAX_JOBS_PER_DEVICE = {
+    "cpu": int(os.environ.get("JOB_WORKERS_CPU", 1)),
+    "cuda": int(os.environ.get("JOB_WORKERS_CUDA", 4)),
+}
+# jobs waiting for a worker (all devices) before POST /jobs says 503
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 32))
+# finished jobs (and their srt) are forgotten after this
+JOB_TTL_SEC = float(os.environ.get("JOB_TTL_SEC", 3600))
+
+# share of the progress bar that audio extraction stands for
+_EXTRACT_SHARE = 0.05
+
+
+def _to_srt(cues: list) -> str:
+    return "\n".join(srt_cue(c["index"], c["start"], c["end"], c["text"]) for c in cues)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(
+        self,
+        spool,
+        filename: str,
+        ext: str,
+        language: str,
+        device: str,
+        model: str,
+        compute_type: str,
+        start: float = None,
+        end: float = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.ext = ext
+        self.language = language
+        self.device = device
+        self.model = model
+        self.compute_type = compute_type
+        # only this range of the input (seconds), cue times stay those of the input
+        self.start = start
+        self.end = end
+        self.status = "queued"  # queued -> running -> done | failed | cancelled
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.cues = []  # {"index", "start", "end", "text", "progress"} as they decode
+        self.cached = False
+        self.upload_bytes = None
+        self.audio_sec = None
+        self.timings = {}  # stage -> seconds
+        self._key = None  # result cache key, see lookup()
+        self._spool = spool
+        self._cancel = threading.Event()
+        self._changed = threading.Condition()
+        self._followers = set()  # (loop, asyncio.Event) of async followers waiting
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "language": self.language,
+            "device": self.device,
+            "model": self.model,
+            "compute_type": self.compute_type,
+            "start": self.start,
+            "end": self.end,
+            "status": self.status,
+            "progress": round(self.progress, 4),
+            "error": self.error,
+            "cached": self.cached,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    async def follow(self, heartbeat: float = None):
+        """
+        Async iterator over the cues, from the first one, waiting for new
+        ones until the job is finished. Any number of followers is fine, none
+        of them holds a thread while waiting. With `heartbeat`, yields None
+        whenever nothing arrived for that long.
+        """
+        loop = asyncio.get_running_loop()
+        i = 0
+        while True:
+            waiter = (loop, asyncio.Event())
+            with self._changed:
+                new = self.cues[i:]
+                finished = self.finished
+                if not new and not finished:
+                    self._followers.add(waiter)
+            if not new and not finished:
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+                finally:
+                    with self._changed:
+                        self._followers.discard(waiter)
+                continue
+            for cue in new:
+                yield cue
+            i += len(new)
+            if finished and i >= len(self.cues):
+                return
+
+    def _notify(self):
+        # under self._changed, from the worker thread
+        self._changed.notify_all()
+        for loop, event in self._followers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # loop already closed
+                pass
+
+    def _finish(self, status: str):
+        with self._changed:
+            self.status = status
+            self.finished_at = time.time()
+            self._notify()
+
+    def _finish_from_cache(self, cues: list):
+        with self._changed:
+            self.cues = cues
+            self.cached = True
+            self.result = _to_srt(cues)
+            self.progress = 1.0
+        self._finish("done")
+
+    def _check_cancel(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    @property
+    def kind(self) -> str:
+        return "audio" if self.ext in SUPPORTED_AUDIO_EXTENSIONS else "video"
+
+    def _timed(self, stage: str, fn, *args):
+        t = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[stage] = time.perf_counter() - t
+            metrics.STAGE_SECONDS.labels(stage, self.kind).observe(self.timings[stage])
+
+    def _log_timing(self):
+        metrics.log_timing(
+            event="job",
+            id=self.id,
+            status=self.status,
+            device=self.device,
+            model=self.model,
+            compute_type=self.compute_type,
+            kind=self.kind,
+            cached=self.cached,
+            upload_bytes=self.upload_bytes,
+            audio_sec=self.audio_sec,
+            cues=len(self.cues),
+            queued_ms=round((self.started_at - self.created_at) * 1000, 1),
+            **{
+                f"{stage}_ms": round(sec * 1000, 1)
+                for stage, sec in self.timings.items()
+            },
+        )
+
+    def lookup(self) -> bool:
+        """
+        Hash the upload and check the result cache, before the job ever waits
+        for a device. True on a hit, the job is done then.
+        """
+        self.upload_bytes = os.fstat(self._spool.fileno()).st_size
+        metrics.UPLOAD_BYTES.labels(self.kind).observe(self.upload_bytes)
+        self._key = result_key(
+            self._timed("hash", hash_upload, self._spool),
+            self.language,
+            self.model,
+            self.device,
+            self.compute_type,
+            self.start,
+            self.end,
+        )
+        cues = result_cache.get(self._key)
+        if cues is None:
+            return False
+        self._spool.close()
+        self.started_at = time.time()
+        self._finish_from_cache(cues)
+        self._log_timing()
+        return True
+
+    def run(self):
+        # runs on a device worker thread
+        self.started_at = time.time()
+        self.status = "running"
+        try:
+            self._run()
+        except JobCancelled:
+            self._finish("cancelled")
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self._finish("failed")
+        finally:
+            self._log_timing()
+
+    def _run(self):
+        self._check_cancel()
+        try:
+            audio = self._timed(
+                "extract", extract_audio, self._spool, self.ext, self.start, self.end
+            )
+        finally:
+            self._spool.close()
+        self.audio_sec = round(len(audio) / SAMPLE_RATE, 3)
+        self.progress = _EXTRACT_SHARE
+        self._check_cancel()
+
+        lang = None if self.language == "auto" else self.language
+        segments = transcribe_segments(
+            audio, lang, self.device, self.model, self.compute_type
+        )
+        offset = self.start or 0.0
+        t = time.perf_counter()
+        for index, (start, end, text, fraction) in enumerate(segments, start=1):
+            self._check_cancel()
+            progress = _EXTRACT_SHARE + (1 - _EXTRACT_SHARE) * fraction
+            cue = {
+                "index": index,
+                "start": offset + start,
+                "end": offset + end,
+                "text": text,
+                "progress": round(progress, 4),
+            }
+            with self._changed:
+                self.cues.append(cue)
+                self.progress = progress
+                self._notify()
+        # wall time incl. waiting for a device slot / batch, the model's own
+        # time is in captions_inference_seconds
+        self.timings["transcribe"] = time.perf_counter() - t
+        metrics.STAGE_SECONDS.labels("transcribe", self.kind).observe(
+            self.timings["transcribe"]
+        )
+
+        self.result = _to_srt(self.cues)
+        self.progress = 1.0
+        try:
+            result_cache.put(self._key, self.cues)
+        except OSError as e:
+            # a full/readonly cache dir shouldn't cost the user the result
+            metrics.log.warning(f"result cache write failed: {e}")
+        self._finish("done")
+
+
+class JobManager:
+    """
+    Background transcription jobs. Each device gets its own small thread
+    pool, so a long CPU job never holds up a CUDA one and vice versa.
+    """
+
+    def __init__(self, workers_per_device: dict, max_queued: int, ttl: float):
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._pools = {
+            device: ThreadPoolExecutor(
+                max_workers=n, thread_name_prefix=f"job-{device}"
+            )
+            for device, n in workers_per_device.items()
+        }
+
+    @property
+    def devices(self):
+        return set(self._pools)
+
+    def queued(self, device: str = None) -> int:
+        with self._lock:
+            return self._queued(device)
+
+    def _queued(self, device: str = None) -> int:
+        # under self._lock
+        return sum(
+            1
+            for j in self._jobs.values()
+            if j.status == "queued" and device in (None, j.device)
+        )
+
+    def submit(
+        self,
+        spool,
+        filename: str,
+        ext: str,
+        language: str,
+        device: str,
+        model: str,
+        compute_type: str,
+        start: float = None,
+        end: float = None,
+    ) -> Job:
+        """
+        `spool` is handed over to the job, it gets closed once the audio is
+        extracted. Hashes the upload right here (blocking, call it off the
+        event loop): a result cache hit comes back done and never queues.
+        Raises QueueFull when too many jobs are waiting.
+        """
+        self._purge()
+        job = Job(
+            spool, filename, ext, language, device, model, compute_type, start, end
+        )
+        try:
+            hit = job.lookup()
+            # check and insert in one go, else concurrent uploads all see
+            # room and overshoot max_queued
+            with self._lock:
+                if hit:
+                    job.future = Future()
+                    job.future.set_result(None)
+                elif self._queued() >= self.max_queued:
+                    raise QueueFull()
+                else:
+                    job.future = self._pools[device].submit(job.run)
+                self._jobs[job.id] = job
+        except BaseException:
+            spool.close()
+            raise
+        return job
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job._cancel.set()
+        # still waiting for a worker -> never runs at all
+        if job.future.cancel():
+            job._spool.close()
+            job._finish("cancelled")
+        return job
+
+    async def wait(self, job: Job) -> Job:
+        try:
+            await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            if not job.future.cancelled():
+                raise
+        return job
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if job.finished and job.finished_at < cutoff:
+                    del self._jobs[job_id]
+
+
+jobs = JobManager(MAX_JOBS_PER_DEVICE, MAX_QUEUED_JOBS, JOB_TTL_SEC)
@@ -1,59 +1,253 @@
-import tempfile
+import json
 import os
-import shutil
+import threading
+import time
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
-from fastapi.responses import Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-from helpers import extract_audio, transcribe_to_srt, SUPPORTED_VIDEO_EXTENSIONS
+import metrics
+from batching import batch_stats
+from helpers import SUPPORTED_EXTENSIONS, srt_cue, vtt_cue
+from jobs import jobs, QueueFull
 from languages import LANGUAGES
+from result_cache import result_cache
+from models import (
+    COMPUTE_TYPES, DEFAULT_MODEL_SIZE, MODEL_SIZES, model_spec, model_stats, preload,
+    queue_depth, replica_models, resident_models,
+)
 
-app = FastAPI(title="Caption Generator with Whisper")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # in the background, so the port opens right away. requests for a model
+    # that is still loading just wait for it instead of loading it twice
+    threading.Thread(target=preload, daemon=True).start()
+    yield
+
+
+app = FastAPI(title="Caption Generator with Whisper", lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
+metrics.watch(jobs, result_cache)
+
 
 @app.middleware("http")
 async def log_req(request: Request, call_next):
-    cl = request.headers.get("content-length")
-    print("incoming", request.method, request.url.path, "content-length", cl)
-    return await call_next(request)
+    t = time.perf_counter()
+    response = None
+    try:
+        response = await call_next(request)
+        return response
+    finally:
+        seconds = time.perf_counter() - t
+        status = response.status_code if response is not None else 500
+        # the route template, not the path, or every job id is its own series
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.REQUEST_SECONDS.labels(request.method, route, str(status)).observe(seconds)
+        metrics.log_timing(
+            event="request",
+            method=request.method,
+            path=request.url.path,
+            status=status,
+            content_length=request.headers.get("content-length"),
+            job_id=response.headers.get("x-job-id") if response is not None else None,
+            ms=round(seconds * 1000, 2),
+        )
 
-@app.post("/transcribe")
-async def transcribe_video(
-    file: UploadFile = File(...),
-    language: str = Form("auto"),
-    device: str = Form("cpu")
-):
+
+async def _submit(file: UploadFile, language: str, device: str, model: str = None,
+                  compute_type: str = None, start: float = None, end: float = None):
     ext = os.path.splitext(file.filename)[1].lower()
-    if ext not in SUPPORTED_VIDEO_EXTENSIONS:
-        raise HTTPException(status_code=400, detail="Unsupported video format")
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Unsupported file format")
+    if (start is not None and start < 0) or (end is not None and end <= (start or 0)):
+        raise HTTPException(status_code=400, detail="Need 0 <= start < end")
+    if device not in jobs.devices:
+        raise HTTPException(status_code=400, detail="Unsupported device")
+    try:
+        model, compute_type = model_spec(device, model, compute_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp_video:
-        shutil.copyfileobj(file.file, tmp_video)
-        video_path = tmp_video.name
+    # the upload gets closed when this request ends, the job outlives it.
+    # keep our own fd on the spool (fileno() rolls it over to disk) -> no copy
+    spool = os.fdopen(os.dup(file.file.fileno()), "rb")
 
     try:
-        audio_path = extract_audio(video_path)
-        lang = None if language == "auto" else language
-        srt_content = transcribe_to_srt(audio_path, lang, device)
-    finally:
-        for p in (video_path, audio_path):
-            if p and os.path.exists(p):
-                os.remove(p)
+        # hashes the upload for the result cache, keep that off the event loop
+        return await run_in_threadpool(
+            jobs.submit,
+            spool, file.filename, ext, language, device, model, compute_type, start, end
+        )
+    except QueueFull:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many jobs queued, try again later",
+            headers={"Retry-After": "30"},
+        )
+
 
-    out_name = os.path.splitext(file.filename)[0]
+def _srt_response(job):
+    out_name = os.path.splitext(job.filename)[0]
 
     return Response(
-        content=srt_content,
+        content=job.result,
         media_type="application/x-subrip",
         headers={
             "Content-Disposition": f'attachment; filename="{out_name}"'
         }
     )
 
+
+STREAM_MEDIA_TYPES = {
+    "srt": "application/x-subrip",
+    "vtt": "text/vtt",
+    "sse": "text/event-stream",
+}
+# sse comment this often while nothing decodes, keeps proxies from timing out
+_SSE_HEARTBEAT_SEC = 15.0
+
+
+def _stream_response(job, fmt: str):
+    """
+    Cues go out as faster-whisper yields them. srt/vtt are the plain file,
+    chunk by chunk; sse sends one `cue` event per segment (with progress)
+    and a final event named after how the job ended.
+    """
+    if fmt not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be srt, vtt or sse")
+
+    async def body():
+        # async, a client waiting on a queued job doesn't tie up a threadpool thread
+        if fmt == "vtt":
+            yield "WEBVTT\n\n"
+        heartbeat = _SSE_HEARTBEAT_SEC if fmt == "sse" else None
+        async for cue in job.follow(heartbeat):
+            if cue is None:
+                yield ": keepalive\n\n"
+            elif fmt == "srt":
+                yield srt_cue(cue["index"], cue["start"], cue["end"], cue["text"]) + "\n"
+            elif fmt == "vtt":
+                yield vtt_cue(cue["start"], cue["end"], cue["text"]) + "\n"
+            else:
+                yield f"event: cue\ndata: {json.dumps(cue)}\n\n"
+        if fmt == "sse":
+            yield f"event: {job.status}\ndata: {json.dumps(job.as_dict())}\n\n"
+
+    return StreamingResponse(
+        body(),
+        media_type=STREAM_MEDIA_TYPES[fmt],
+        headers={"X-Job-Id": job.id, "Cache-Control": "no-cache"},
+    )
+
+
+@app.post("/transcribe")
+async def transcribe_video(
+    file: UploadFile = File(...),
+    language: str = Form("auto"),
+    device: str = Form("cpu"),
+    model: str = Form(None),
+    compute_type: str = Form(None),
+    start: float = Form(None),
+    end: float = Form(None),
+):
+    # same worker pool as /jobs, we just wait for it here without blocking the loop
+    job = await jobs.wait(await _submit(file, language, device, model, compute_type, start, end))
+    if job.status != "done":
+        # the exception text is for the log, not for whoever uploaded
+        metrics.log.error(f"job {job.id} {job.status}: {job.error}")
+        raise HTTPException(
+            status_code=500, detail=f"transcription {job.status} (job {job.id})"
+        )
+    return _srt_response(job)
+
+
+@app.post("/transcribe/stream")
+async def transcribe_stream(
+    file: UploadFile = File(...),
+    language: str = Form("auto"),
+    device: str = Form("cpu"),
+    model: str = Form(None),
+    compute_type: str = Form(None),
+    start: float = Form(None),
+    end: float = Form(None),
+    format: str = Form("sse"),
+):
+    # still a regular job: the id is in X-Job-Id, a dropped client can re-attach
+    job = await _submit(file, language, device, model, compute_type, start, end)
+    return _stream_response(job, format)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    language: str = Form("auto"),
+    device: str = Form("cpu"),
+    model: str = Form(None),
+    compute_type: str = Form(None),
+    start: float = Form(None),
+    end: float = Form(None),
+):
+    return (await _submit(file, language, device, model, compute_type, start, end)).as_dict()
+
+
+def _get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    return _get_job(job_id).as_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str):
+    job = _get_job(job_id)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return _srt_response(job)
+
+
+@app.get("/jobs/{job_id}/stream")
+def job_stream(job_id: str, format: str = "sse"):
+    """Replays the cues decoded so far, then follows the job live."""
+    return _stream_response(_get_job(job_id), format)
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    jobs.cancel(job_id)
+    return _get_job(job_id).as_dict()
+
+@app.get("/models")
+def list_models():
+    return {
+        "sizes": MODEL_SIZES,
+        "default_size": DEFAULT_MODEL_SIZE,
+        "compute_types": COMPUTE_TYPES,
+        "resident": resident_models(),
+        "replicas": replica_models(),
+        "stats": model_stats(),
+        "batching": batch_stats(),
+        "queue_depth": queue_depth(),
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/")
 def ui(request: Request):
     return templates.TemplateResponse(
         "index.html",
-        {"request": request, "languages": LANGUAGES}
-    )
\ No newline at end of file
+        {"request": request, "languages": LANGUAGES, "model_sizes": MODEL_SIZES,
+         "default_size": DEFAULT_MODEL_SIZE}
+    )
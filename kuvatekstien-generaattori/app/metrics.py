@@ -0,0 +1,176 @@
+import json
+import logging
+
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+log = logging.getLogger("caption-generator")
+if not log.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_handler)
+    log.setLevel(logging.INFO)
+
+_MB = 1024**2
+
+REQUEST_SECONDS = Histogram(
+    "captions_request_seconds",
+    "HTTP request time until the response starts (streams excluded)",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120, 600),
+)
+UPLOAD_BYTES = Histogram(
+    "captions_upload_bytes",
+    "Size of uploaded media",
+    ["kind"],
+    buckets=tuple(n * _MB for n in (1, 5, 20, 50, 100, 250, 500, 1000, 2000)),
+)
+STAGE_SECONDS = Histogram(
+    "captions_job_stage_seconds",
+    "Time spent per job stage (hash, extract, transcribe)",
+    ["stage", "kind"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120, 600, 1800),
+)
+INFERENCE_SECONDS = Histogram(
+    "captions_inference_seconds",
+    "Time inside the model per inference run (a whole batch when batched)",
+    ["device", "model", "compute_type"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+RTF = Histogram(
+    "captions_inference_rtf",
+    "Real-time factor per inference run, inference seconds / audio seconds",
+    ["device", "model", "compute_type"],
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2),
+)
+
+
+def observe_inference(
+    device: str, size: str, compute_type: str, seconds: float, audio_sec: float
+):
+    INFERENCE_SECONDS.labels(device, size, compute_type).observe(seconds)
+    if audio_sec:
+        RTF.labels(device, size, compute_type).observe(seconds / audio_sec)
+
+
+def log_timing(**fields):
+    log.info(json.dumps(fields))
+
+
+class _StateCollector:
+    """Reads live job, model and cache state at scrape time instead of mirroring it."""
+
+    def __init__(self, jobs, result_cache):
+        self.jobs = jobs
+        self.result_cache = result_cache
+
+    def collect(self):
+        # models imports us, so read it lazily
+        from models import model_stats, queue_depth, replica_models, resident_models
+
+        jobs_queued = GaugeMetricFamily(
+            "captions_jobs_queued", "Jobs waiting for a worker", labels=["device"]
+        )
+        for device in sorted(self.jobs.devices):
+            jobs_queued.add_metric([device], self.jobs.queued(device))
+        yield jobs_queued
+
+        waiting = GaugeMetricFamily(
+            "captions_inference_queue_depth",
+            "Inferences waiting for a device slot",
+            labels=["device"],
+        )
+        for device, n in queue_depth().items():
+            waiting.add_metric([device], n)
+        yield waiting
+
+        labels = ["device", "model", "compute_type"]
+        resident = GaugeMetricFamily(
+            "captions_model_resident", "Loaded models (1 per model)", labels=labels
+        )
+        memory = GaugeMetricFamily(
+            "captions_model_memory_mb",
+            "Estimated footprint of loaded models",
+            labels=labels,
+        )
+        leases = GaugeMetricFamily(
+            "captions_model_leases", "Leases out on a loaded model", labels=labels
+        )
+        for m in resident_models():
+            key = [m["device"], m["model"], m["compute_type"]]
+            resident.add_metric(key, 1)
+            memory.add_metric(key, m["memory_mb"])
+            leases.add_metric(key, m["leases"])
+        yield resident
+        yield memory
+        yield leases
+
+        replicas = GaugeMetricFamily(
+            "captions_model_replicas",
+            "Model copies in the chunked pool's processes",
+            labels=labels,
+        )
+        replica_memory = GaugeMetricFamily(
+            "captions_model_replica_memory_mb",
+            "Estimated footprint of the replicas",
+            labels=labels,
+        )
+        for m in replica_models():
+            key = [m["device"], m["model"], m["compute_type"]]
+            replicas.add_metric(key, m["replicas"])
+            replica_memory.add_metric(key, m["memory_mb"])
+        yield replicas
+        yield replica_memory
+
+        counters = {
+            "hits": CounterMetricFamily(
+                "captions_model_cache_hits",
+                "Model requests served by a loaded model",
+                labels=labels,
+            ),
+            "loads": CounterMetricFamily(
+                "captions_model_loads", "Model loads", labels=labels
+            ),
+            "evictions": CounterMetricFamily(
+                "captions_model_evictions",
+                "Models unloaded to make room for another",
+                labels=labels,
+            ),
+            "unloads": CounterMetricFamily(
+                "captions_model_unloads",
+                "Models unloaded by the idle/pressure sweeper",
+                labels=labels,
+            ),
+            "load_sec": CounterMetricFamily(
+                "captions_model_load_seconds",
+                "Time spent loading models",
+                labels=labels,
+            ),
+        }
+        for st in model_stats():
+            key = [st["device"], st["model"], st["compute_type"]]
+            for name, family in counters.items():
+                family.add_metric(key, st[name])
+        yield from counters.values()
+
+        stats = self.result_cache.stats()
+        yield GaugeMetricFamily(
+            "captions_result_cache_bytes",
+            "Bytes of cached transcriptions",
+            value=stats["bytes"],
+        )
+        lookups = CounterMetricFamily(
+            "captions_result_cache_lookups", "Result cache lookups", labels=["result"]
+        )
+        lookups.add_metric(["hit"], stats["hits"])
+        lookups.add_metric(["miss"], stats["misses"])
+        yield lookups
+        yield CounterMetricFamily(
+            "captions_result_cache_evictions",
+            "Results evicted for space",
+            value=stats["evictions"],
+        )
+
+
+def watch(jobs, result_cache):
+    REGISTRY.register(_StateCollector(jobs, result_cache))
@@ -0,0 +1,478 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from faster_whisper import WhisperModel
+
+import metrics
+
+MODEL_SIZES = ("tiny", "base", "small", "medium", "large-v3")
+
+# what ctranslate2 actually runs on each device, first one is the default
+COMPUTE_TYPES = {
+    "cuda": ("float16", "int8_float16", "int8", "float32"),
+    "cpu": ("int8", "int8_float32", "float32"),
+}
+
+DEFAULT_MODEL_SIZE = os.environ.get("MODEL_SIZE", "medium")
+
+# loaded models per device have to fit in this (rough estimate, see below)
+MODEL_MEMORY_BUDGET_MB = {
+    "cpu": int(os.environ.get("MODEL_MEMORY_BUDGET_MB_CPU", 4096)),
+    "cuda": int(os.environ.get("MODEL_MEMORY_BUDGET_MB_CUDA", 6144)),
+}
+
+# parameter counts (millions) and bytes per weight, good enough to budget with
+_PARAMS_M = {"tiny": 39, "base": 74, "small": 244, "medium": 769, "large-v3": 1550}
+_BYTES_PER_WEIGHT = {
+    "int8": 1,
+    "int8_float16": 1,
+    "int8_float32": 1,
+    "float16": 2,
+    "float32": 4,
+}
+# runtime buffers on top of the weights
+_OVERHEAD_MB = 200
+
+# (size, device, compute_type) -> WhisperModel, least recently used first
+_MODELS = OrderedDict()
+# keys being constructed right now, outside the lock. they count against the
+# budget already, whoever wants the same model waits for it to show up
+_LOADING = set()
+# copies of a model living in other processes (chunked.py's replica pool),
+# key -> count. they take memory like the rest and count against the budget
+_REPLICAS = {}
+
+# what happens to loaded models nobody uses:
+#   idle     -> unloaded after MODEL_IDLE_TIMEOUT_SEC
+#   pressure -> stay until the budget needs room or the box runs low on memory
+# pinned models never go away, preloaded ones are loaded + warmed at startup
+MODEL_RESIDENCY = os.environ.get("MODEL_RESIDENCY", "idle")
+MODEL_IDLE_TIMEOUT_SEC = float(os.environ.get("MODEL_IDLE_TIMEOUT_SEC", 600))
+# pressure: unload once MemAvailable drops below this
+MODEL_MIN_FREE_MB = int(os.environ.get("MODEL_MIN_FREE_MB", 1024))
+# comma separated "size:device[:compute_type]"
+MODEL_PRELOAD = os.environ.get("MODEL_PRELOAD", "")
+MODEL_PINNED = os.environ.get("MODEL_PINNED", "")
+
+_MODEL_LAST_USED = {}
+# leases out per model, a model with any is never unloaded
+_MODEL_REFS = {}
+_MODEL_LOCK = threading.Lock()
+# a lease was returned, maybe there is room now
+_MODEL_FREED = threading.Condition(_MODEL_LOCK)
+_SWEEPER_STARTED = False
+_SWEEP_INTERVAL_SEC = 2.0
+
+# load vs inference time per (size, device, compute_type)
+_STATS = {}
+
+# inferences running at once per device, the rest queue up. one on cuda,
+# two models decoding side by side is how VRAM runs out
+INFERENCE_SLOTS = {
+    "cpu": int(os.environ.get("INFERENCE_SLOTS_CPU", os.cpu_count() or 1)),
+    "cuda": int(os.environ.get("INFERENCE_SLOTS_CUDA", 1)),
+}
+_SLOTS = {
+    device: threading.BoundedSemaphore(n) for device, n in INFERENCE_SLOTS.items()
+}
+_SLOT_WAITING = dict.fromkeys(INFERENCE_SLOTS, 0)
+
+
+def model_spec(device: str, size: str = None, compute_type: str = None) -> tuple:
+    """
+    Fill in the defaults and check a requested (size, compute_type) makes
+    sense on `device`. Raises ValueError if not.
+    """
+    if device not in COMPUTE_TYPES:
+        raise ValueError(f"unsupported device {device!r}")
+    size = size or DEFAULT_MODEL_SIZE
+    compute_type = compute_type or COMPUTE_TYPES[device][0]
+    if size not in MODEL_SIZES:
+        raise ValueError(f"model must be one of {', '.join(MODEL_SIZES)}")
+    if compute_type not in COMPUTE_TYPES[device]:
+        raise ValueError(
+            f"compute type on {device} must be one of {', '.join(COMPUTE_TYPES[device])}"
+        )
+    return size, compute_type
+
+
+def parse_specs(value: str) -> list:
+    """ "medium:cpu,large-v3:cuda:int8_float16" -> [(size, device, compute_type)]"""
+    keys = []
+    for item in filter(None, (v.strip() for v in value.split(","))):
+        size, device, *rest = item.split(":")
+        size, compute_type = model_spec(device, size, rest[0] if rest else None)
+        keys.append((size, device, compute_type))
+    return keys
+
+
+_PINNED = set(parse_specs(MODEL_PINNED))
+
+
+def model_memory_mb(size: str, compute_type: str) -> int:
+    return _PARAMS_M[size] * _BYTES_PER_WEIGHT[compute_type] + _OVERHEAD_MB
+
+
+def _resident_mb(device: str) -> int:
+    mb = sum(model_memory_mb(s, c) for s, d, c in [*_MODELS, *_LOADING] if d == device)
+    mb += sum(
+        model_memory_mb(s, c) * n for (s, d, c), n in _REPLICAS.items() if d == device
+    )
+    return mb
+
+
+def _maybe_empty_cuda_cache():
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+
+
+def _release(models: list):
+    # Drop reference + collect garbage to encourage VRAM release.
+    if not models:
+        return
+    cuda = any(key[1] == "cuda" for key, _ in models)
+    models.clear()
+    gc.collect()
+    if cuda:
+        _maybe_empty_cuda_cache()
+
+
+def _unload_model(key: tuple):
+    # Remove cached model and force cleanup, unless someone got a lease meanwhile
+    with _MODEL_LOCK:
+        if key not in _MODELS or _MODEL_REFS.get(key):
+            return
+        unloaded = [(key, _MODELS.pop(key))]
+        _MODEL_LAST_USED.pop(key, None)
+        _stats(key)["unloads"] += 1
+
+    _release(unloaded)
+
+
+def _mem_available_mb():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def _sweeper_loop():
+    while True:
+        now = time.monotonic()
+        to_unload = []
+
+        with _MODEL_LOCK:
+            unpinned = [
+                key
+                for key in _MODELS
+                if key not in _PINNED and not _MODEL_REFS.get(key)
+            ]
+            if MODEL_RESIDENCY == "idle":
+                for key in unpinned:
+                    if (now - _MODEL_LAST_USED.get(key, now)) >= MODEL_IDLE_TIMEOUT_SEC:
+                        to_unload.append(key)
+            elif MODEL_RESIDENCY == "pressure" and unpinned:
+                free = _mem_available_mb()
+                if free is not None and free < MODEL_MIN_FREE_MB:
+                    # one per sweep, least recently used first
+                    to_unload.append(unpinned[0])
+
+        for key in to_unload:
+            _unload_model(key)
+
+        time.sleep(_SWEEP_INTERVAL_SEC)
+
+
+def _ensure_sweeper_started():
+    global _SWEEPER_STARTED
+    with _MODEL_LOCK:
+        if _SWEEPER_STARTED:
+            return
+
+        # daemon sweeper thread
+        t = threading.Thread(target=_sweeper_loop, daemon=True)
+        t.start()
+        _SWEEPER_STARTED = True
+
+
+def _fits(key: tuple) -> bool:
+    size, device, compute_type = key
+    return (
+        _resident_mb(device) + model_memory_mb(size, compute_type)
+        <= MODEL_MEMORY_BUDGET_MB[device]
+    )
+
+
+def _evict_for(key: tuple) -> list:
+    size, device, compute_type = key
+    return _evict_until(device, model_memory_mb(size, compute_type))
+
+
+def _evict_until(device: str, need_mb: int) -> list:
+    # under _MODEL_LOCK: drop least recently used models on `device` until
+    # `need_mb` more fits the budget. pinned and leased ones stay
+    evicted = []
+    for other in list(_MODELS):
+        if _resident_mb(device) + need_mb <= MODEL_MEMORY_BUDGET_MB[device]:
+            break
+        if other[1] != device or other in _PINNED or _MODEL_REFS.get(other):
+            continue
+        evicted.append((other, _MODELS.pop(other)))
+        _MODEL_LAST_USED.pop(other, None)
+        _stats(other)["evictions"] += 1
+    return evicted
+
+
+def _acquire(key: tuple):
+    size, device, compute_type = key
+    with _MODEL_LOCK:
+        loaded = False
+        while key not in _MODELS:
+            if key in _LOADING:
+                # someone else is loading it, wait for it to be published (or fail)
+                _MODEL_FREED.wait()
+                continue
+            # make room first, two big models side by side is what OOMs
+            evicted = _evict_for(key)
+            if evicted:
+                # gc and emptying the cuda cache take a while, not under the
+                # lock. anything may have changed after, so look again
+                _MODEL_LOCK.release()
+                try:
+                    _release(evicted)
+                finally:
+                    _MODEL_LOCK.acquire()
+                continue
+            busy = any(_MODEL_REFS.get(k) for k in _MODELS if k[1] == device)
+            busy = busy or any(k[1] == device for k in _LOADING)
+            if busy and not _fits(key):
+                # the rest is in use, wait for a lease to come back.
+                # nothing in use and still too big -> the estimate is off, load anyway
+                _MODEL_FREED.wait()
+                continue
+
+            # loading takes seconds (minutes if it downloads), don't hold up
+            # slots, leases and /metrics meanwhile
+            _LOADING.add(key)
+            _MODEL_LOCK.release()
+            try:
+                t0 = time.perf_counter()
+                model = WhisperModel(size, device=device, compute_type=compute_type)
+            finally:
+                _MODEL_LOCK.acquire()
+                _LOADING.discard(key)
+                _MODEL_FREED.notify_all()
+            _MODELS[key] = model
+            loaded = True
+            stats = _stats(key)
+            stats["loads"] += 1
+            stats["load_sec"] += time.perf_counter() - t0
+        if not loaded:
+            _stats(key)["hits"] += 1
+        _MODELS.move_to_end(key)
+        _MODEL_REFS[key] = _MODEL_REFS.get(key, 0) + 1
+        _MODEL_LAST_USED[key] = time.monotonic()
+        return _MODELS[key]
+
+
+@contextmanager
+def lease(device: str, size: str = None, compute_type: str = None):
+    """
+    The cached model for (size, device, compute_type), loaded if needed.
+    Neither the sweeper nor budget eviction touch it until the block exits.
+    """
+    _ensure_sweeper_started()
+    size, compute_type = model_spec(device, size, compute_type)
+    key = (size, device, compute_type)
+    model = _acquire(key)
+    try:
+        yield model
+    finally:
+        with _MODEL_LOCK:
+            _MODEL_REFS[key] -= 1
+            if not _MODEL_REFS[key]:
+                del _MODEL_REFS[key]
+            # idle time counts from the end of the last use, not the start
+            _MODEL_LAST_USED[key] = time.monotonic()
+            _MODEL_FREED.notify_all()
+
+
+def add_replicas(device: str, size: str, compute_type: str, n: int):
+    """
+    Count `n` out-of-process copies of a model against the device budget,
+    idle in-process models are evicted to make room.
+    """
+    key = (size, device, compute_type)
+    with _MODEL_LOCK:
+        _REPLICAS[key] = _REPLICAS.get(key, 0) + n
+        # they're already there (or about to be), nothing to wait for
+        evicted = _evict_until(device, 0)
+    _release(evicted)
+
+
+def remove_replicas(device: str, size: str, compute_type: str, n: int):
+    key = (size, device, compute_type)
+    with _MODEL_LOCK:
+        _REPLICAS[key] -= n
+        if not _REPLICAS[key]:
+            del _REPLICAS[key]
+        _MODEL_FREED.notify_all()
+
+
+def acquire_slot(device: str, timeout: float = None) -> bool:
+    """device_slot() for callers that release somewhere else (a callback)."""
+    with _MODEL_LOCK:
+        _SLOT_WAITING[device] += 1
+    try:
+        return _SLOTS[device].acquire(timeout=timeout)
+    finally:
+        with _MODEL_LOCK:
+            _SLOT_WAITING[device] -= 1
+
+
+def release_slot(device: str):
+    _SLOTS[device].release()
+
+
+@contextmanager
+def device_slot(device: str):
+    """One of the device's INFERENCE_SLOTS, waits in line for it if needed."""
+    acquire_slot(device)
+    try:
+        yield
+    finally:
+        release_slot(device)
+
+
+def queue_depth() -> dict:
+    with _MODEL_LOCK:
+        return dict(_SLOT_WAITING)
+
+
+def _stats(key: tuple) -> dict:
+    if key not in _STATS:
+        _STATS[key] = {
+            "hits": 0,
+            "loads": 0,
+            "load_sec": 0.0,
+            "warmup_sec": 0.0,
+            # evictions: made room for another model, unloads: idle/pressure sweeper
+            "evictions": 0,
+            "unloads": 0,
+            "inferences": 0,
+            "inference_sec": 0.0,
+            "audio_sec": 0.0,
+        }
+    return _STATS[key]
+
+
+def record_inference(
+    device: str, size: str, compute_type: str, seconds: float, audio_sec: float
+):
+    with _MODEL_LOCK:
+        stats = _stats((size, device, compute_type))
+        stats["inferences"] += 1
+        stats["inference_sec"] += seconds
+        stats["audio_sec"] += audio_sec
+    metrics.observe_inference(device, size, compute_type, seconds, audio_sec)
+
+
+def warm_up(device: str, size: str = None, compute_type: str = None):
+    """
+    Load a model and push a second of silence through it, so the first real
+    request doesn't pay for the load nor for the lazy init of the first run.
+    """
+    size, compute_type = model_spec(device, size, compute_type)
+    with device_slot(device), lease(device, size, compute_type) as model:
+        t0 = time.perf_counter()
+        # vad would throw the silence away before the model ever saw it
+        segments, _ = model.transcribe(
+            np.zeros(16000, dtype=np.float32), language="en", vad_filter=False
+        )
+        for _ in segments:
+            pass
+    with _MODEL_LOCK:
+        _stats((size, device, compute_type))["warmup_sec"] += time.perf_counter() - t0
+
+
+def preload():
+    # pinned ones first, they're the ones promised to be there
+    for size, device, compute_type in sorted(
+        _PINNED | set(parse_specs(MODEL_PRELOAD)), key=lambda k: k not in _PINNED
+    ):
+        try:
+            warm_up(device, size, compute_type)
+            metrics.log_timing(
+                event="preload", model=size, device=device, compute_type=compute_type
+            )
+        except Exception as e:
+            metrics.log.error(
+                f"preloading {size} on {device} failed: {type(e).__name__}: {e}"
+            )
+
+
+def resident_models() -> list:
+    with _MODEL_LOCK:
+        return [
+            {
+                "model": s,
+                "device": d,
+                "compute_type": c,
+                "memory_mb": model_memory_mb(s, c),
+                "pinned": (s, d, c) in _PINNED,
+                "leases": _MODEL_REFS.get((s, d, c), 0),
+                "idle_sec": round(
+                    time.monotonic() - _MODEL_LAST_USED.get((s, d, c), 0), 1
+                ),
+            }
+            for s, d, c in _MODELS
+        ]
+
+
+def replica_models() -> list:
+    """Out-of-process copies (chunked.py's pool), counted in the budget too."""
+    with _MODEL_LOCK:
+        return [
+            {
+                "model": s,
+                "device": d,
+                "compute_type": c,
+                "replicas": n,
+                "memory_mb": model_memory_mb(s, c) * n,
+            }
+            for (s, d, c), n in _REPLICAS.items()
+        ]
+
+
+def model_stats() -> list:
+    """Time spent loading vs transcribing, per model ever loaded."""
+    with _MODEL_LOCK:
+        return [
+            {
+                "model": s,
+                "device": d,
+                "compute_type": c,
+                **{k: round(v, 3) for k, v in stats.items()},
+                "avg_load_sec": round(stats["load_sec"] / stats["loads"], 3)
+                if stats["loads"]
+                else None,
+                "rtf": round(stats["inference_sec"] / stats["audio_sec"], 4)
+                if stats["audio_sec"]
+                else None,
+            }
+            for (s, d, c), stats in _STATS.items()
+        ]
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# a volume in the container (see the Dockerfile), survives restarts and redeploys
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 256 * 1024**2))
+
+_HASH_CHUNK = 1024 * 1024
+
+
+def hash_upload(src) -> str:
+    """sha256 of the whole upload, leaves the file position at the start."""
+    h = hashlib.sha256()
+    src.seek(0)
+    for chunk in iter(lambda: src.read(_HASH_CHUNK), b""):
+        h.update(chunk)
+    src.seek(0)
+    return h.hexdigest()
+
+
+def result_key(
+    content_hash: str,
+    language: str,
+    model: str,
+    device: str,
+    compute_type: str,
+    start: float = None,
+    end: float = None,
+) -> str:
+    # same bytes with another language/model/range is another transcription
+    raw = f"{content_hash}:{language}:{model}:{device}:{compute_type}:{start}:{end}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Finished transcriptions (the cue list) on local disk, one json file per
+    key, capped at `max_bytes` with lru eviction. The index is rebuilt from
+    the directory on start, file atime keeps the lru order across restarts.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> size, oldest first
+        self._lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+        self._reconcile()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+
+    def _reconcile(self):
+        found = []
+        with os.scandir(self.root) as it:
+            for f in it:
+                if f.name.endswith(".tmp"):
+                    os.remove(f.path)
+                elif f.name.endswith(".json") and f.is_file():
+                    st = f.stat()
+                    found.append(
+                        (
+                            max(st.st_atime, st.st_mtime),
+                            f.name[: -len(".json")],
+                            st.st_size,
+                        )
+                    )
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                cues = json.load(f)
+            os.utime(self._path(key))
+            return cues
+        except (OSError, ValueError):
+            # vanished or half-broken, treat as a miss from now on
+            with self._lock:
+                self._drop(key)
+            return None
+
+    def put(self, key: str, cues: list):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(cues, f, ensure_ascii=False)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = size
+            self.total_bytes += size
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _drop(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
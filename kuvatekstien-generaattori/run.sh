@@ -1,3 +1,3 @@
 #!/bin/bash
 
-docker run --gpus all --name cap-gen --network deeverse_proxy --env-file .env -d -p 8000:8000 xuanminator/caption-gen:1.0
+docker run --gpus all --name cap-gen --network deeverse_proxy --env-file .env -v cap-gen-cache:/cache -d -p 8000:8000 xuanminator/caption-gen:1.0
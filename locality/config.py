@@ -5,10 +5,14 @@
 import os
 import json
 import sys
+import threading
+from datetime import datetime, timedelta
 from pathlib import Path
 
 APP_NAME = "locale_master"
 CONFIG_PATH = Path(os.path.expanduser(f"~/.{APP_NAME}.json"))
+# weather lives in its own file, written far more often than the config
+WEATHER_CACHE_PATH = Path(os.path.expanduser(f"~/.{APP_NAME}_weather.json"))
 
 DEFAULT_CITIES = [
     {"name": "Seoul", "lat": 37.5665, "lon": 126.9780, "tz": "Asia/Seoul"},
@@ -38,6 +42,8 @@ def load_config():
         "cities": DEFAULT_CITIES,
         "format_24h": True,
         "weather_cache": {},  # code->icon cache & per-city timestamps
+        "weather_ttl_min": 10,  # refresh interval per city
+        "weather_max_stale_min": 180,  # older cached weather isn't shown at startup
         "icon_path": None,
     }
 
@@ -46,8 +52,51 @@ def save_config(cfg):
     try:
         cfg = dict(cfg)
         cfg.pop("weather_cache", None) # not persisting cache in config cuz weather = ephemeral
+        cfg.pop("weather_validators", None) # same, see save_weather_cache
         
         with open(CONFIG_PATH, "w", encoding="utf-8") as f:
             json.dump(cfg, f, ensure_ascii=False, indent=2)
     except Exception as e:
         print("Failed to save config:", e)
+
+
+_weather_cache_lock = threading.Lock()
+
+
+def load_weather_cache(icon_dir, max_stale=timedelta(hours=3)):
+    """
+    Weather from the last run -> ({"lat,lon": (iso_ts, icon, temp)}, validators).
+    Entries older than `max_stale` are dropped, the rest get painted right away.
+    """
+    cache, validators = {}, {}
+    if not WEATHER_CACHE_PATH.exists():
+        return cache, validators
+    try:
+        with open(WEATHER_CACHE_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        now = datetime.now()
+        for key, e in data.get("entries", {}).items():
+            if now - datetime.fromisoformat(e["ts"]) < max_stale:
+                # only the file name is stored, the icon dir moves between runs (pyinstaller)
+                cache[key] = (e["ts"], os.path.join(icon_dir, e["icon"]), e["temp"])
+        validators = data.get("validators", {})
+    except Exception as e:
+        print("Failed to load weather cache:", e)
+    return cache, validators
+
+
+def save_weather_cache(cache, validators=None):
+    # called from worker threads; copy first, the dicts keep changing
+    entries = {
+        key: {"ts": ts, "icon": os.path.basename(icon), "temp": temp}
+        for key, (ts, icon, temp) in dict(cache).items()
+    }
+    data = {"entries": entries, "validators": dict(validators or {})}
+    try:
+        with _weather_cache_lock:
+            tmp = WEATHER_CACHE_PATH.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, WEATHER_CACHE_PATH)  # never leave a half written file
+    except Exception as e:
+        print("Failed to save weather cache:", e)
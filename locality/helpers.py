@@ -53,42 +53,105 @@ def get_full_icon_path(weather_code, icon_dir, extension=".png"):
     return full_path
 
 
-def fetch_current_weather(lat, lon, tz, icon_dir, cache=None):
+# one pooled connection for every open-meteo call, no handshake per fetch
+_session = requests.Session()
+
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+
+
+def weather_key(lat, lon):
+    return f"{lat},{lon}"
+
+
+# http validators kept per distinct request, oldest dropped past this
+_MAX_VALIDATORS = 32
+
+
+def fetch_weather_batch(
+    cities, icon_dir, cache=None, max_age=timedelta(minutes=10), validators=None
+):
     """
-    Returns (weather_icon, temperature_c) using Open-Meteo. May raise requests exceptions.
+    Current weather for many cities in one Open-Meteo request.
+    Returns {"lat,lon": (weather_icon, temperature_c)}. Cities younger than
+    `max_age` in `cache` aren't asked for again; on failure only those are returned.
+    `validators` keeps ETag/Last-Modified per request for conditional GETs,
+    when the api hands them out.
     """
-    key = f"{lat},{lon}"
+    out = {}
+    todo = []
+    for city in cities:
+        key = weather_key(city["lat"], city["lon"])
+        if cache and key in cache:
+            ts_str, icon, temp = cache[key]
+            # TTL check
+            if datetime.now() - datetime.fromisoformat(ts_str) < max_age:
+                out[key] = (icon, temp)
+                continue
+        todo.append(city)
+
+    if not todo:
+        return out
+
+    # open-meteo takes comma separated lists, answers with a list in that order
+    params = {
+        "latitude": ",".join(str(c["lat"]) for c in todo),
+        "longitude": ",".join(str(c["lon"]) for c in todo),
+        "timezone": ",".join(c["tz"] or "auto" for c in todo),
+        "current_weather": "true",
+    }
+
+    # a 304 is only useful if every city in the request is cached
+    sig = "|".join((params["latitude"], params["longitude"], params["timezone"]))
+    headers = {}
+    known = validators.get(sig) if validators is not None else None
+    if known and cache and all(weather_key(c["lat"], c["lon"]) in cache for c in todo):
+        if known.get("etag"):
+            headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            headers["If-Modified-Since"] = known["last_modified"]
 
-    if cache and key in cache:
-        ts_str, icon, temp = cache[key]
-        # TTL check
-        if datetime.now() - datetime.fromisoformat(ts_str) < timedelta(minutes=10):
-            return icon, temp
+    try:
+        r = _session.get(FORECAST_URL, params=params, headers=headers, timeout=8)
+        now = datetime.now().isoformat(timespec="seconds")
 
-    url = (
-        "https://api.open-meteo.com/v1/forecast?"
-        f"latitude={lat}&longitude={lon}&current_weather=true&timezone={tz}"
-    )
+        if r.status_code == 304:  # unchanged, the cached entries are current again
+            for city in todo:
+                key = weather_key(city["lat"], city["lon"])
+                _, icon, temp = cache[key]
+                cache[key] = (now, icon, temp)
+                out[key] = (icon, temp)
+            return out
 
-    try:
-        r = requests.get(url, timeout=8)
         r.raise_for_status()
         data = r.json()
-        cw = data.get("current_weather", {})
-
-        icon = get_full_icon_path(
-            cw.get("weathercode"), icon_dir
-        )  # must return full path
-        temp = cw.get("temperature")
-
-        if cache is not None:
-            cache[key] = (datetime.now().isoformat(timespec="seconds"), icon, temp)
-
-        return icon, temp
+        if isinstance(data, dict):  # single location -> plain object
+            data = [data]
+
+        if validators is not None:
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+            validators.pop(sig, None)
+            if etag or last_modified:
+                validators[sig] = {"etag": etag, "last_modified": last_modified}
+                while len(validators) > _MAX_VALIDATORS:
+                    validators.pop(next(iter(validators)))
+
+        for city, item in zip(todo, data):
+            cw = item.get("current_weather", {})
+            icon = get_full_icon_path(
+                cw.get("weathercode"), icon_dir
+            )  # must return full path
+            temp = cw.get("temperature")
+
+            key = weather_key(city["lat"], city["lon"])
+            out[key] = (icon, temp)
+            if cache is not None:
+                cache[key] = (now, icon, temp)
 
     except Exception as e:
         log(f"Something went wrong: {e}")
-        return
+
+    return out
 
 
 def geocode_city(name):
@@ -101,7 +164,7 @@ def geocode_city(name):
         f"name={requests.utils.requote_uri(name)}&count=1&language=en&format=json"
     )
     try:
-        r = requests.get(url, timeout=8)
+        r = _session.get(url, timeout=8)
         r.raise_for_status()
         data = r.json()
         results = data.get("results") or []
@@ -2,16 +2,17 @@
 # UI
 # ---------------------------
 
+import queue
 import sys
-import threading
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import tkinter as tk
 from tkinter import simpledialog, messagebox
 
-from config import save_config, get_asset_path
-from helpers import fetch_current_weather, geocode_city
+from config import save_config, get_asset_path, load_weather_cache, save_weather_cache
+from helpers import geocode_city, weather_key
+from weather import WeatherScheduler
 
 
 class Row(tk.Frame):
@@ -21,7 +22,6 @@ class Row(tk.Frame):
         self.cfg.setdefault("weather_cache", {})
         self.city = city
         self.font = font
-        self.fetching = False
         self.icon_img = None
         self.icon_dir = cfg["icon_path"]
         left = tk.Frame(self, bg="#111111")
@@ -42,65 +42,30 @@ class Row(tk.Frame):
 
         self.weather_icon = "…"
         self.temperature = None
-        self.last_weather_fetch = datetime.min
 
     def update_time(self, use_24h=True):
         now = datetime.now(ZoneInfo(self.city["tz"]))
         fmt = "%Y-%m-%d %H:%M" if use_24h else "%Y-%m-%d %I-%M %p"
         self.name_lbl.config(text=self.city["name"])
         self.time_lbl.config(text=now.strftime(fmt))
-        self.icon_lbl.config(image=self.icon_img)
+        # no icon (yet, or it didn't load) -> the placeholder
+        if self.icon_img is None:
+            self.icon_lbl.config(image="", text=self.weather_icon)
+        else:
+            self.icon_lbl.config(image=self.icon_img, text="")
 
         if self.temperature is None:
             self.temp_lbl.config(text="")
         else:
             self.temp_lbl.config(text=f"{round(self.temperature)}°C")
 
-    def maybe_update_weather(
-        self, min_interval=timedelta(minutes=10)
-    ):  # runs on main thread
-        if self.fetching:
-            return
-        if datetime.now() - self.last_weather_fetch < min_interval:
-            return
-
-        def worker():  # bg thread
-            self.fetching = True
-
-            result = fetch_current_weather(
-                self.city["lat"],
-                self.city["lon"],
-                self.city["tz"],
-                self.icon_dir,
-                cache=self.cfg["weather_cache"],
-            )
-            if not result:
-                self.after(0, lambda: setattr(self, "fetching", False))
-                return
-            
-            icon, temp = result
-
-            def apply():  # UI must be handled by main
-                self.icon_img = tk.PhotoImage(file=icon)
-                self.temperature = temp
-                self.last_weather_fetch = datetime.now()
-                self.fetching = False
-
-            self.after(0, apply)  # scheduled to be on the tk main loop
-
-            # # This runs UI job directly in the back -> cpu spike
-            # try:
-            #     icon, temp = fetch_current_weather(
-            #         self.city["lat"], self.city["lon"], self.city["tz"], self.icon_dir
-            #     )
-            #     self.icon_img = tk.PhotoImage(file=icon)
-            #     self.temperature = temp
-            #     self.last_weather_fetch = datetime.now()
-            # except Exception:
-            #     # Leave previous icon/temp; try again later
-            #     pass
-
-        threading.Thread(target=worker, daemon=True).start()
+    def set_weather(self, icon, temp):  # main thread only
+        try:
+            self.icon_img = tk.PhotoImage(file=icon)
+        except tk.TclError:
+            # icon gone or unreadable (e.g. a cache entry from another install)
+            self.icon_img = None
+        self.temperature = temp
 
 
 class Widget(tk.Tk):
@@ -160,6 +125,20 @@ class Widget(tk.Tk):
         )
 
         self.rows = []
+        # last run's weather paints the rows now, the scheduler revalidates behind it
+        max_stale = timedelta(minutes=cfg.get("weather_max_stale_min", 180))
+        self.cfg["weather_cache"], self.cfg["weather_validators"] = load_weather_cache(
+            self.cfg["icon_path"], max_stale
+        )
+        self.weather = WeatherScheduler(
+            self.cfg["icon_path"],
+            self.cfg["weather_cache"],
+            validators=self.cfg["weather_validators"],
+            interval=cfg.get("weather_ttl_min", 10) * 60,
+            on_update=lambda: save_weather_cache(
+                self.cfg["weather_cache"], self.cfg["weather_validators"]
+            ),
+        )
         self.build_rows()
 
         # Keyboard
@@ -168,6 +147,7 @@ class Widget(tk.Tk):
 
         # Periodic update loops
         self.update_loop()
+        self.poll_weather()
 
         # Save window pos on close
         self.protocol("WM_DELETE_WINDOW", self.safe_quit)
@@ -183,6 +163,13 @@ class Widget(tk.Tk):
             row.pack(fill="x", pady=2)
             self.rows.append(row)
 
+            # rebuilt rows start blank, paint what we already know
+            cached = self.cfg["weather_cache"].get(weather_key(city["lat"], city["lon"]))
+            if cached:
+                row.set_weather(*cached[1:])
+
+        self.weather.set_cities(self.cfg["cities"])
+
     def _on_start(self, event):
         self._drag_start = (
             event.x_root - self.winfo_x(),
@@ -221,6 +208,7 @@ class Widget(tk.Tk):
         pos = (self.winfo_x(), self.winfo_y())
         self.cfg["window"]["x"], self.cfg["window"]["y"] = pos
         save_config(self.cfg)
+        self.weather.stop()
         self.destroy()
 
     def add_city_dialog(self):
@@ -276,5 +264,16 @@ class Widget(tk.Tk):
         # Update times every 0.5s for snappy minutes transition
         for r in self.rows:
             r.update_time(use_24h=self.cfg.get("format_24h", True))
-            r.maybe_update_weather(min_interval=timedelta(minutes=10))
         self.after(5000, self.update_loop)
+
+    def poll_weather(self):
+        # the scheduler's results, applied here on the tk main loop
+        while True:
+            try:
+                key, icon, temp = self.weather.results.get_nowait()
+            except queue.Empty:
+                break
+            for r in self.rows:
+                if weather_key(r.city["lat"], r.city["lon"]) == key:
+                    r.set_weather(icon, temp)
+        self.after(500, self.poll_weather)
@@ -0,0 +1,148 @@
+# ---------------------------
+# Weather refresh scheduler
+# ---------------------------
+
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from helpers import fetch_weather_batch, log, weather_key
+
+REFRESH_INTERVAL = 10 * 60  # seconds, default when none is given
+JITTER = 0.1  # +-10% on every interval, cities drift apart instead of firing together
+COALESCE = 60  # cities due within this window ride along in the same request
+BATCH_MAX = 50  # cities per open-meteo request
+BACKOFF_BASE = 30
+BACKOFF_MAX = 30 * 60
+WORKERS = 2
+
+
+class WeatherScheduler:
+    """
+    One thread decides which city is due, a small fixed pool does the
+    fetching. Results land in `results` as (key, icon, temp); tk drains it
+    on the main loop, nothing here touches widgets. Cities with a cached
+    entry are first due when that entry turns `interval` old, and
+    `on_update` runs after every fetch that brought something new.
+    """
+
+    def __init__(
+        self,
+        icon_dir,
+        cache,
+        validators=None,
+        interval=REFRESH_INTERVAL,
+        on_update=None,
+        workers=WORKERS,
+    ):
+        self.results = queue.Queue()
+        self.icon_dir = icon_dir
+        self.cache = cache
+        self.validators = validators
+        self.interval = interval
+        self.on_update = on_update
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="weather"
+        )
+        self._cond = threading.Condition()
+        self._cities = {}  # key -> city
+        self._due = {}  # key -> time.monotonic() of next refresh
+        self._failures = {}  # key -> failed attempts in a row
+        self._inflight = set()
+        self._stopped = False
+        threading.Thread(
+            target=self._loop, daemon=True, name="weather-scheduler"
+        ).start()
+
+    def set_cities(self, cities):
+        with self._cond:
+            self._cities = {weather_key(c["lat"], c["lon"]): c for c in cities}
+            now = time.monotonic()
+            for key in self._cities:
+                if key not in self._due:
+                    # new city -> right away, unless the cache still covers it
+                    self._due[key] = now + self._fresh_for(key)
+            for key in list(self._due):
+                if key not in self._cities:
+                    del self._due[key]
+                    self._failures.pop(key, None)
+            self._cond.notify()
+
+    def _fresh_for(self, key):
+        # seconds until the cached entry is due a refresh, 0 without one
+        entry = self.cache.get(key)
+        if not entry:
+            return 0
+        age = (datetime.now() - datetime.fromisoformat(entry[0])).total_seconds()
+        return max(0, self.interval - age)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _next_batch(self):
+        # blocks until something is due, None once stopped
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                idle = [k for k in self._due if k not in self._inflight]
+                first = min((self._due[k] for k in idle), default=None)
+                if first is not None and first <= now:
+                    keys = [k for k in idle if self._due[k] <= now + COALESCE]
+                    self._inflight.update(keys)
+                    return [self._cities[k] for k in keys]
+                self._cond.wait(None if first is None else first - now)
+            return None
+
+    def _loop(self):
+        while True:
+            cities = self._next_batch()
+            if cities is None:
+                return
+            for i in range(0, len(cities), BATCH_MAX):
+                try:
+                    self._pool.submit(self._fetch, cities[i : i + BATCH_MAX])
+                except RuntimeError:  # pool shut down under us
+                    return
+
+    def _fetch(self, cities):
+        try:
+            # the scheduler owns the timing, always ask the api
+            results = fetch_weather_batch(
+                cities,
+                self.icon_dir,
+                cache=self.cache,
+                max_age=timedelta(0),
+                validators=self.validators,
+            )
+        except Exception as e:
+            log(f"Something went wrong: {e}")
+            results = {}
+
+        now = time.monotonic()
+        with self._cond:
+            for city in cities:
+                key = weather_key(city["lat"], city["lon"])
+                self._inflight.discard(key)
+                if key not in self._cities:  # removed meanwhile
+                    continue
+                if key in results:
+                    self._failures.pop(key, None)
+                    self._due[key] = now + self.interval * random.uniform(
+                        1 - JITTER, 1 + JITTER
+                    )
+                    self.results.put((key, *results[key]))
+                else:
+                    # 30s, 1m, 2m, ... up to 30m, jittered so failures don't sync up
+                    n = self._failures[key] = self._failures.get(key, 0) + 1
+                    delay = min(BACKOFF_BASE * 2 ** (n - 1), BACKOFF_MAX)
+                    self._due[key] = now + delay * random.uniform(0.5, 1)
+            self._cond.notify()
+
+        if results and self.on_update is not None:
+            self.on_update()